@@ -3,17 +3,33 @@
 import os
 import sys
 import json
+import hashlib
 import logging
+import pickle
+import shutil
 import time
 import argparse
+from collections import ChainMap, defaultdict
+from itertools import chain
+from email.parser import BytesParser
+from operator import itemgetter
 from pathlib import Path
-from collections import deque
+import threading
 import concurrent.futures
-import filecmp
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import requests
 from dotenv import load_dotenv
+
+# orjson is ~3-10x faster than stdlib json for the scan files; fall back if absent.
+try:
+    import orjson
+    def _json_dumps_bytes(obj): return orjson.dumps(obj)
+    _json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    def _json_dumps_bytes(obj): return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    _json_loads = json.loads
 from google.oauth2 import service_account
 from google.auth.transport.requests import AuthorizedSession
 from requests.adapters import HTTPAdapter
@@ -26,6 +42,7 @@ AUTH_DIR = BASE_DIR / "authentication"
 SERVICE_ACCOUNT_KEY_PATH = AUTH_DIR / "service-account-key.json"
 STATES_DIR = BASE_DIR / "data" / "states"
 STATE_FILE = STATES_DIR / "change_listener_state.json"
+TOKEN_CACHE_FILE = STATES_DIR / "access_token.json"
 TEMP_DIR = BASE_DIR / "temp_files"
 
 # --- Logging Setup ---
@@ -43,15 +60,71 @@ NTBLM_DRIVE_ID = "0APlttYcHDqnvUk9PVA"
 UPLOAD_FOLDER_NAME = "3-NTBLM"
 REPORTS_SUBFOLDER_NAME = "Reports"
 LOGS_SUBFOLDER_NAME = "Logs"
-POLLING_INTERVAL_SECONDS = 600
+# Overridable via .env; push notifications would need a public HTTPS endpoint
+# this service does not have, so a tunable poll is the practical knob for
+# trading change-detection latency against idle API calls.
+POLLING_INTERVAL_SECONDS = int(os.getenv('POLLING_INTERVAL_SECONDS', '600'))
 SCHEDULED_RESCAN_HOURS = 6
 DRIVE_API_V3_URL = "https://www.googleapis.com/drive/v3"
+SCAN_PATCH_FILENAME = "drive_scan_patch.jsonl"
+PATCH_COMPACTION_RATIO = 0.1  # Rewrite the snapshot once the patch log outgrows 10% of it.
+SCAN_RATE_LIMIT_QPS = 9  # Drive enforces ~10 QPS per user; stay just under it.
+SCAN_MAX_WORKERS = max(8, 3 * (os.cpu_count() or 4))
+SCAN_MAX_IN_FLIGHT = 200
 
 if not DRIVE_FOLDER_ID:
     logging.critical("CRITICAL: DRIVE_FOLDER_ID not set in .env file. Exiting.")
     sys.exit(1)
 
 # --- Core Functions ---
+class TokenBucket:
+    """Token-bucket rate limiter shared by all scan workers."""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+_scan_rate_limiter = TokenBucket(SCAN_RATE_LIMIT_QPS)
+
+_downstream_thread = None
+
+def trigger_downstream_scripts(full_run=False, include_matcher=True):
+    """Runs the matcher/planner in-process instead of spawning a fresh interpreter per script.
+
+    Runs on a background thread so the polling loop is not blocked; failures are
+    logged rather than allowed to kill the listener. At most one downstream run
+    is in flight at a time — a trigger while one is still running is dropped.
+    """
+    global _downstream_thread
+    if _downstream_thread and _downstream_thread.is_alive():
+        logging.info("Downstream scripts are still running; skipping this trigger.")
+        return
+    def _run():
+        try:
+            if include_matcher:
+                import report_matcher
+                report_matcher.run(full_run=full_run)
+            import preparation_planner
+            preparation_planner.run(full_run=full_run)
+        except Exception as e:
+            logging.error(f"Downstream script run failed: {e}", exc_info=True)
+    _downstream_thread = threading.Thread(target=_run, name="DownstreamScripts", daemon=True)
+    _downstream_thread.start()
+
 def get_credentials():
     if not SERVICE_ACCOUNT_KEY_PATH.exists():
         logging.critical(f"Service account key file not found at: {SERVICE_ACCOUNT_KEY_PATH}")
@@ -59,27 +132,101 @@ def get_credentials():
     scopes = ['https://www.googleapis.com/auth/drive']
     try:
         creds = service_account.Credentials.from_service_account_file(str(SERVICE_ACCOUNT_KEY_PATH), scopes=scopes)
-        return creds
     except Exception as e:
         logging.critical(f"Failed to load credentials: {e}", exc_info=True)
         sys.exit(1)
+    # Reuse the last access token if still valid, so a restart within the
+    # ~1 hour token lifetime skips the JWT exchange round-trip.
+    try:
+        if TOKEN_CACHE_FILE.exists():
+            cached = json.loads(TOKEN_CACHE_FILE.read_text())
+            expiry = datetime.fromisoformat(cached['expiry'])
+            if expiry > datetime.utcnow() + timedelta(minutes=5):
+                creds.token = cached['token']
+                creds.expiry = expiry
+                logging.info("Reusing cached access token.")
+    except Exception as e:
+        logging.warning(f"Could not load cached access token: {e}")
+    return creds
+
+def save_token_cache(credentials):
+    try:
+        if credentials.token and credentials.expiry:
+            STATES_DIR.mkdir(parents=True, exist_ok=True)
+            TOKEN_CACHE_FILE.write_text(json.dumps({'token': credentials.token, 'expiry': credentials.expiry.isoformat()}))
+    except Exception as e:
+        logging.warning(f"Could not persist access token cache: {e}")
+
+FIND_CACHE_TTL_SECONDS = 300
+_find_cache = {}
+
+def _invalidate_find_cache(name=None, parent_id=None):
+    """Drops cached lookups matching name and/or parent_id after a mutation."""
+    for key in [k for k in _find_cache if (name is None or k[0] == name) and (parent_id is None or k[1] == parent_id)]:
+        del _find_cache[key]
 
-def find_drive_item_by_name(session, name, parent_id=None, drive_id=None, mime_type=None, order_by=None):
-    safe_name = name.replace("'", "\\'")
-    query_parts = [f"name = '{safe_name}'" if not name.startswith(".") else f"name contains '{safe_name}'", "trashed = false"]
+def build_session():
+    """Builds the shared AuthorizedSession with a tuned keep-alive pool.
+
+    google-auth has no httpx/HTTP2 transport, so connection reuse is the lever:
+    one pool sized for the scan fan-out, with pool_block=True so workers wait
+    for a pooled socket instead of paying a fresh TCP+TLS handshake.
+    """
+    session = AuthorizedSession(get_credentials())
+    adapter = HTTPAdapter(pool_connections=100, pool_maxsize=100, pool_block=True,
+                          # 429s are prevented by the shared token bucket, not retried:
+                          # blind backoff across the worker pool just herds retries.
+                          max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[500, 503], respect_retry_after_header=True))
+    session.mount("https://", adapter)
+    return session
+
+def find_drive_item_by_name(session, name, parent_id=None, drive_id=None, mime_type=None, order_by=None, contains=False):
+    cache_key = (name, parent_id, drive_id, mime_type, order_by, contains)
+    cached = _find_cache.get(cache_key)
+    if cached and (time.time() - cached[0]) < FIND_CACHE_TTL_SECONDS:
+        return cached[1]
+    # Names almost never contain quotes; skip the replace-allocation unless needed.
+    safe_name = name.replace("'", "\\'") if "'" in name else name
+    query_parts = [f"name contains '{safe_name}'" if contains else f"name = '{safe_name}'", "trashed = false"]
     if parent_id: query_parts.append(f"'{parent_id}' in parents")
-    params = {'q': " and ".join(query_parts), 'fields': 'files(id, name, modifiedTime)', 'supportsAllDrives': True, 'includeItemsFromAllDrives': True}
+    # Only the first hit is ever used, so let the server stop after one.
+    params = {'q': " and ".join(query_parts), 'fields': 'files(id,name,modifiedTime,size)', 'pageSize': 1, 'supportsAllDrives': True, 'includeItemsFromAllDrives': True}
     if drive_id: params['driveId'] = drive_id; params['corpora'] = 'drive'
     if order_by: params['orderBy'] = order_by
     try:
+        _scan_rate_limiter.acquire()
         response = session.get(f"{DRIVE_API_V3_URL}/files", params=params)
         response.raise_for_status()
-        files = response.json().get('files', [])
-        return files[0] if files else None
+        files = _json_loads(response.content).get('files', [])
+        result = files[0] if files else None
+        _find_cache[cache_key] = (time.time(), result)
+        return result
     except Exception as e:
         logging.error(f"Error finding item '{name}': {e}")
         return None
 
+_upload_folder_id = None
+
+def _invalidate_upload_folder(state=None):
+    """Forgets the cached upload folder ID (and the persisted copy) so the
+    next use re-resolves it instead of looping on a stale ID forever."""
+    global _upload_folder_id
+    _upload_folder_id = None
+    if state is not None: state.pop("upload_folder_id", None)
+
+def get_upload_folder_id(session, state=None):
+    """Resolves the NTBLM upload folder once, reusing the ID across cycles and restarts."""
+    global _upload_folder_id
+    if _upload_folder_id: return _upload_folder_id
+    if state and state.get("upload_folder_id"):
+        _upload_folder_id = state["upload_folder_id"]
+        return _upload_folder_id
+    folder = find_drive_item_by_name(session, UPLOAD_FOLDER_NAME, drive_id=NTBLM_DRIVE_ID)
+    if folder:
+        _upload_folder_id = folder['id']
+        if state is not None: state["upload_folder_id"] = _upload_folder_id
+    return _upload_folder_id
+
 def find_or_create_folder(session, folder_name, parent_id, drive_id):
     folder = find_drive_item_by_name(session, folder_name, parent_id=parent_id, drive_id=drive_id)
     if folder: return folder['id']
@@ -88,15 +235,71 @@ def find_or_create_folder(session, folder_name, parent_id, drive_id):
         response = session.post(f"{DRIVE_API_V3_URL}/files", json=file_metadata, params={'supportsAllDrives': 'true'})
         response.raise_for_status()
         logging.info(f"Created folder '{folder_name}'.")
+        _invalidate_find_cache(name=folder_name, parent_id=parent_id)
         return response.json()['id']
     except Exception as e:
         logging.error(f"Failed to create folder '{folder_name}': {e}")
         return None
 
+RESUMABLE_UPLOAD_THRESHOLD_BYTES = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE_BYTES = 16 * 1024 * 1024
+
+def _upload_resumable(session, local_path, file_metadata):
+    """Drive resumable upload: initiate a session, then PUT chunks straight from disk.
+
+    Unlike the multipart path, this never materializes the whole file in memory.
+    """
+    total = local_path.stat().st_size
+    init = session.post("https://www.googleapis.com/upload/drive/v3/files",
+                        params={'uploadType': 'resumable', 'supportsAllDrives': 'true'},
+                        json=file_metadata, headers={'X-Upload-Content-Length': str(total)})
+    init.raise_for_status()
+    upload_url = init.headers['Location']
+    response = None
+    with open(local_path, 'rb') as f:
+        sent = 0
+        while sent < total:
+            chunk = f.read(UPLOAD_CHUNK_SIZE_BYTES)
+            headers = {'Content-Length': str(len(chunk)), 'Content-Range': f'bytes {sent}-{sent + len(chunk) - 1}/{total}'}
+            response = session.put(upload_url, data=chunk, headers=headers)
+            if response.status_code == 308:
+                # 308 acks only the server-confirmed prefix, which can be short
+                # of what we sent; resume from its offset, not ours.
+                range_header = response.headers.get('Range', '')
+                confirmed = int(range_header.rsplit('-', 1)[-1]) + 1 if '-' in range_header else 0
+                if confirmed <= sent:
+                    raise Exception(f"Resumable upload of '{local_path.name}' made no progress at byte {sent}")
+                if confirmed != sent + len(chunk): f.seek(confirmed)
+                sent = confirmed
+                continue
+            if response.status_code not in (200, 201):
+                response.raise_for_status()
+            sent += len(chunk)
+    # Anything but a 200/201 here means Drive persisted fewer bytes than we
+    # sent; treating it as success would silently accept a truncated file.
+    if response is None or response.status_code not in (200, 201):
+        status = response.status_code if response is not None else 'no response'
+        raise Exception(f"Resumable upload of '{local_path.name}' ended with {status}; server confirmed {sent}/{total} bytes")
+    return response
+
+_upload_hashes = {}
+
+def _sha256_of_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
 def backup_and_upload(session, local_path, folder_id, drive_id, current_filename, backup_filename):
     if not local_path.exists() or local_path.stat().st_size == 0:
         logging.info(f"Local file '{local_path.name}' is empty or missing. Skipping upload for '{current_filename}'.")
-        return
+        return True
+    # A quiet cycle rewrites byte-identical content; skip the round-trips entirely.
+    local_hash = _sha256_of_file(local_path)
+    if _upload_hashes.get((current_filename, folder_id)) == local_hash:
+        logging.info(f"'{current_filename}' unchanged since last upload. Skipping no-op upload.")
+        return True
     try:
         existing_file = find_drive_item_by_name(session, current_filename, parent_id=folder_id, drive_id=drive_id)
         if existing_file:
@@ -108,30 +311,127 @@ def backup_and_upload(session, local_path, folder_id, drive_id, current_filename
             logging.info(f"Backed up '{current_filename}' to '{backup_filename}'.")
         
         file_metadata = {'name': current_filename, 'parents': [folder_id]}
-        with open(local_path, 'rb') as f:
-            files = {'data': ('metadata', json.dumps(file_metadata), 'application/json'), 'file': f}
-            response = session.post(f"https://www.googleapis.com/upload/drive/v3/files", params={'uploadType': 'multipart', 'supportsAllDrives': 'true'}, files=files)
-            response.raise_for_status()
+        if local_path.stat().st_size >= RESUMABLE_UPLOAD_THRESHOLD_BYTES:
+            _upload_resumable(session, local_path, file_metadata)
+        else:
+            with open(local_path, 'rb') as f:
+                files = {'data': ('metadata', json.dumps(file_metadata), 'application/json'), 'file': f}
+                response = session.post(f"https://www.googleapis.com/upload/drive/v3/files", params={'uploadType': 'multipart', 'supportsAllDrives': 'true'}, files=files)
+                response.raise_for_status()
         logging.info(f"Successfully uploaded new '{current_filename}'.")
+        _upload_hashes[(current_filename, folder_id)] = local_hash
+        _invalidate_find_cache(name=current_filename, parent_id=folder_id)
+        _invalidate_find_cache(name=backup_filename, parent_id=folder_id)
+        return True
     except Exception as e:
         logging.error(f"Backup and upload failed for '{current_filename}': {e}")
+        return False
+
+def _batch_metadata_chunk(session, chunk, fields):
+    """Fetches metadata for up to 100 IDs in one multipart/mixed batch request."""
+    results = {}
+    boundary = "drive_listener_batch"
+    parts = []
+    for n, item_id in enumerate(chunk):
+        parts.append(f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <item{n}>\r\n\r\nGET /drive/v3/files/{item_id}?fields={fields}&supportsAllDrives=true HTTP/1.1\r\n\r\n")
+    body = "".join(parts) + f"--{boundary}--"
+    try:
+        _scan_rate_limiter.acquire()
+        response = session.post("https://www.googleapis.com/batch/drive/v3", data=body, headers={'Content-Type': f'multipart/mixed; boundary={boundary}'})
+        response.raise_for_status()
+        # Parse the multipart/mixed reply properly; each part wraps one
+        # embedded HTTP response whose body is the JSON for a single file.
+        content_type = response.headers.get('Content-Type', 'multipart/mixed')
+        message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + response.content)
+        payloads = message.get_payload()
+        for part in (payloads if isinstance(payloads, list) else [payloads]):
+            raw = part.get_payload(decode=True)
+            if raw is None: raw = str(part.get_payload()).encode()
+            split = raw.split(b'\r\n\r\n', 1)
+            payload = split[1].strip() if len(split) == 2 else b''
+            if not payload.startswith(b'{'): continue
+            try:
+                item = _json_loads(payload)
+                if 'id' in item: results[item['id']] = item
+            except Exception: continue
+    except Exception as e:
+        logging.error(f"Batch metadata request failed for {len(chunk)} IDs: {e}")
+    return results
+
+def batch_get_metadata(session, item_ids, fields="id,name,parents"):
+    """Fetches metadata for many file IDs, issuing the 100-ID batch calls concurrently."""
+    item_ids = list(item_ids)
+    chunks = [item_ids[i:i + 100] for i in range(0, len(item_ids), 100)]
+    if len(chunks) <= 1:
+        return _batch_metadata_chunk(session, chunks[0], fields) if chunks else {}
+    # Each batch call is one independent round trip; overlap them the same way
+    # the scanner overlaps folder listings instead of paying latency serially.
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(chunks), 8)) as executor:
+        for chunk_results in executor.map(lambda chunk: _batch_metadata_chunk(session, chunk, fields), chunks):
+            results.update(chunk_results)
+    return results
+
+def prefetch_ancestors(session, start_ids, path_cache, metadata_cache):
+    """Batch-fetches every ancestor of start_ids missing from the caches, one batch per tree level."""
+    missing = {item_id for item_id in start_ids if item_id not in path_cache and item_id not in metadata_cache}
+    while missing:
+        fetched = batch_get_metadata(session, missing)
+        metadata_cache.update(fetched)
+        missing = set()
+        for item in fetched.values():
+            parents = item.get('parents') or []
+            for parent_id in parents[:1]:
+                if parent_id != DRIVE_FOLDER_ID and parent_id not in path_cache and parent_id not in metadata_cache:
+                    missing.add(parent_id)
 
 def get_item_metadata(session, item_id, fields="id,name,mimeType,parents,driveId,modifiedTime,size"):
     try:
+        _scan_rate_limiter.acquire()
         response = session.get(f"{DRIVE_API_V3_URL}/files/{item_id}", params={'fields': fields, 'supportsAllDrives': 'true'})
         response.raise_for_status()
-        return response.json()
+        return _json_loads(response.content)
     except Exception as e:
         logging.error(f"API Error getting metadata for ID {item_id}: {e}")
         return None
 
-def download_file(session, file_id, destination_path):
+PARALLEL_DOWNLOAD_THRESHOLD_BYTES = 4 * 1024 * 1024
+PARALLEL_DOWNLOAD_WORKERS = 8
+
+def _download_file_ranged(session, file_id, destination_path, size):
+    """Downloads one file as N parallel Range requests written in place with os.pwrite."""
+    range_size = -(-size // PARALLEL_DOWNLOAD_WORKERS)
+    ranges = [(start, min(start + range_size, size) - 1) for start in range(0, size, range_size)]
+    fd = os.open(destination_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC)
     try:
+        os.truncate(fd, size)
+        def fetch_range(byte_range):
+            start, end = byte_range
+            response = session.get(f"{DRIVE_API_V3_URL}/files/{file_id}?alt=media", params={'supportsAllDrives': 'true'}, headers={'Range': f'bytes={start}-{end}'}, stream=True)
+            response.raise_for_status()
+            offset = start
+            for part in response.iter_content(1 << 20):
+                os.pwrite(fd, part, offset)
+                offset += len(part)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=PARALLEL_DOWNLOAD_WORKERS) as executor:
+            list(executor.map(fetch_range, ranges))
+    finally:
+        os.close(fd)
+    return True
+
+def download_file(session, file_id, destination_path, size=0):
+    """Downloads a file; callers that know the size (e.g. from a list/find
+    result) pass it so large files go ranged without a metadata probe."""
+    try:
+        Path(destination_path).parent.mkdir(parents=True, exist_ok=True)
+        if size >= PARALLEL_DOWNLOAD_THRESHOLD_BYTES:
+            return _download_file_ranged(session, file_id, destination_path, size)
         response = session.get(f"{DRIVE_API_V3_URL}/files/{file_id}?alt=media", params={'supportsAllDrives': 'true'}, stream=True)
         response.raise_for_status()
-        Path(destination_path).parent.mkdir(parents=True, exist_ok=True)
         with open(destination_path, 'wb') as f:
-            for chunk in response.iter_content(8192): f.write(chunk)
+            # copyfileobj skips urllib3's Python-level chunk iteration entirely.
+            response.raw.decode_content = True
+            shutil.copyfileobj(response.raw, f, length=1 << 20)
         return True
     except Exception: return False
 
@@ -142,28 +442,48 @@ def get_start_page_token(session, drive_id):
         return response.json().get('startPageToken')
     except Exception: return None
 
-def list_changes(session, page_token, drive_id):
+def list_changes(session, page_token, drive_id, etag=None):
+    all_changes, new_etag, first_page = [], None, True
     try:
-        params = {'driveId': drive_id, 'pageToken': page_token, 'fields': 'nextPageToken, newStartPageToken, changes(changeType,fileId,removed,file(parents,name,mimeType,size))', 'includeItemsFromAllDrives': True, 'supportsAllDrives': True}
-        response = session.get(f"{DRIVE_API_V3_URL}/changes", params=params)
-        response.raise_for_status()
-        data = response.json()
-        return data.get('changes', []), data.get('newStartPageToken') or data.get('nextPageToken')
+        while page_token:
+            params = {'driveId': drive_id, 'pageToken': page_token, 'pageSize': 1000, 'spaces': 'drive', 'fields': 'nextPageToken,newStartPageToken,changes(changeType,fileId,removed,file(parents,name,mimeType,size))', 'includeItemsFromAllDrives': True, 'supportsAllDrives': True}
+            headers = {'If-None-Match': etag} if (etag and first_page) else {}
+            response = session.get(f"{DRIVE_API_V3_URL}/changes", params=params, headers=headers)
+            if first_page and response.status_code == 304:
+                logging.info("changes.list returned 304 Not Modified; drive is idle.")
+                return [], page_token, etag
+            first_page = False
+            response.raise_for_status()
+            new_etag = response.headers.get('ETag') or new_etag
+            data = _json_loads(response.content)
+            all_changes.extend(data.get('changes', []))
+            new_start_token = data.get('newStartPageToken')
+            if new_start_token:
+                return all_changes, new_start_token, new_etag
+            page_token = data.get('nextPageToken')
+        return all_changes, None, new_etag
     except Exception as e:
         logging.error(f"Unexpected error fetching changes: {e}", exc_info=True)
-        return None, None
+        return None, None, etag
+
+# Prebuilt once; the scan loop issues one request per folder page and should
+# not reallocate the identical boilerplate params each time.
+SCAN_BASE_PARAMS = (('fields', "nextPageToken,files(id,name,mimeType,size,parents)"), ('supportsAllDrives', 'true'), ('includeItemsFromAllDrives', 'true'), ('pageSize', '1000'))
 
 def _scan_worker(session, folder_id, folder_path, indent, drive_id):
     files, folders = [], []
     next_page_token = None
     while True:
-        params = {'q': f"'{folder_id}' in parents and trashed=false", 'fields': "nextPageToken, files(id, name, mimeType, size, parents)", 'supportsAllDrives': True, 'includeItemsFromAllDrives': True, 'pageSize': 1000}
-        if drive_id: params['corpora'] = 'drive'; params['driveId'] = drive_id
-        if next_page_token: params['pageToken'] = next_page_token
+        params = [('q', f"'{folder_id}' in parents and trashed=false"), *SCAN_BASE_PARAMS]
+        if drive_id: params.append(('corpora', 'drive')); params.append(('driveId', drive_id))
+        if next_page_token: params.append(('pageToken', next_page_token))
         try:
+            _scan_rate_limiter.acquire()
             response = session.get(f"{DRIVE_API_V3_URL}/files", params=params)
             response.raise_for_status()
-            data = response.json()
+            # Decode the raw bytes directly; with orjson this releases the GIL
+            # far less than requests' stdlib-json path across the worker threads.
+            data = _json_loads(response.content)
             for item in data.get('files', []):
                 item_data = {**item, 'path': f"{folder_path}/{item['name']}", 'indent': indent}
                 (folders if item['mimeType'] == 'application/vnd.google-apps.folder' else files).append(item_data)
@@ -172,55 +492,134 @@ def _scan_worker(session, folder_id, folder_path, indent, drive_id):
         except Exception: break
     return files, folders
 
-def _perform_scan(session, root_folder_id, root_path, root_indent):
-    scan_results, folders_to_scan = [], deque([{'id': root_folder_id, 'path': root_path, 'indent': root_indent}])
-    with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
-        active_futures = {executor.submit(_scan_worker, session, f['id'], f['path'], f['indent'] + 1, DRIVE_FOLDER_ID) for f in folders_to_scan}
+def _perform_scan(session, root_folder_id, root_path, root_indent, drive_id=None):
+    # Bucket results by depth as they arrive; depth is known at emit time, so
+    # ordering the output needs only a cheap name sort per bucket instead of
+    # one O(N log N) sort over full path strings at the end.
+    buckets, pending_folders = defaultdict(list), []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_MAX_WORKERS) as executor:
+        active_futures = {executor.submit(_scan_worker, session, root_folder_id, root_path, root_indent + 1, drive_id)}
         while active_futures:
             done, active_futures = concurrent.futures.wait(active_futures, return_when=concurrent.futures.FIRST_COMPLETED)
             for future in done:
                 try:
                     child_files, child_folders = future.result()
-                    scan_results.extend(child_files)
-                    scan_results.extend(child_folders)
-                    for subfolder in child_folders:
-                        active_futures.add(executor.submit(_scan_worker, session, subfolder['id'], subfolder['path'], subfolder['indent'] + 1, DRIVE_FOLDER_ID))
+                    for item in chain(child_files, child_folders):
+                        buckets[item['indent']].append(item)
+                    pending_folders.extend(child_folders)
                 except Exception as e:
                     logging.error(f"A scan worker failed: {e}")
-    return scan_results
-
-def get_full_path(session, item_id, path_cache, root_name):
-    if item_id in path_cache: return path_cache[item_id]
-    item = get_item_metadata(session, item_id, fields="id,name,parents")
-    if not item or not item.get('parents') or item['parents'][0] == DRIVE_FOLDER_ID:
-        path = f"{root_name}/{item['name']}" if item and 'name' in item else f"{root_name}/Unknown"
-        path_cache[item_id] = path
-        return path
-    parent_path = get_full_path(session, item['parents'][0], path_cache, root_name)
-    my_path = f"{parent_path}/{item.get('name', 'Unknown')}"
-    path_cache[item_id] = my_path
-    return my_path
+            # Cap in-flight futures so an exploding fan-out cannot exhaust memory.
+            while pending_folders and len(active_futures) < SCAN_MAX_IN_FLIGHT:
+                subfolder = pending_folders.pop()
+                active_futures.add(executor.submit(_scan_worker, session, subfolder['id'], subfolder['path'], subfolder['indent'] + 1, drive_id))
+    for bucket in buckets.values():
+        bucket.sort(key=itemgetter('name'))
+    return list(chain.from_iterable(buckets[depth] for depth in sorted(buckets)))
+
+PATH_CACHE_FILE = STATES_DIR / "path_cache.json"
+PATH_CACHE_MAX_ENTRIES = 50_000
+_shared_path_cache = {}
+
+def _load_shared_path_cache():
+    """Shares resolved paths across cycles (and restarts) instead of rebuilding each time."""
+    if not _shared_path_cache and PATH_CACHE_FILE.exists():
+        try:
+            _shared_path_cache.update(_json_loads(PATH_CACHE_FILE.read_bytes()))
+        except Exception as e:
+            logging.warning(f"Could not load persisted path cache: {e}")
+    if len(_shared_path_cache) > PATH_CACHE_MAX_ENTRIES:
+        _shared_path_cache.clear()
+    return _shared_path_cache
+
+def _save_shared_path_cache():
+    try:
+        STATES_DIR.mkdir(parents=True, exist_ok=True)
+        PATH_CACHE_FILE.write_bytes(_json_dumps_bytes(_shared_path_cache))
+    except Exception as e:
+        logging.warning(f"Could not persist path cache: {e}")
+
+def get_full_path(session, item_id, path_cache, root_name, metadata_cache=None):
+    """Returns (path, indent) for item_id, tracking depth during assembly so
+    callers never have to re-count delimiters over the whole string."""
+    if item_id in path_cache:
+        cached = path_cache[item_id]
+        return cached, cached.count('/') - 1
+    metadata_cache = metadata_cache or {}
+    # Walk ancestors iteratively (no recursion depth limit), collecting the
+    # chain of unknown nodes, then assemble paths top-down in one pass.
+    chain, current_id = [], item_id
+    while current_id not in path_cache:
+        item = metadata_cache.get(current_id) or get_item_metadata(session, current_id, fields="id,name,parents")
+        parents = item.get('parents') if item else None
+        if not item or not parents or parents[0] == DRIVE_FOLDER_ID:
+            path_cache[current_id] = f"{root_name}/{item['name']}" if item and 'name' in item else f"{root_name}/Unknown"
+            break
+        chain.append((current_id, item.get('name', 'Unknown')))
+        current_id = parents[0]
+    current_path = path_cache[current_id]
+    current_indent = current_path.count('/') - 1
+    for node_id, name in reversed(chain):
+        current_path = f"{current_path}/{name}"
+        current_indent += 1
+        path_cache[node_id] = current_path
+    return current_path, current_indent
+
+def rotate_log_file():
+    """Atomically rotates the log file out from under the live FileHandler.
+
+    Truncating with open(..., 'w') while the handler kept its fd left the
+    handler appending at the old offset, producing sparse files full of NULs.
+    Rename instead, close the handler under its lock, and let the next emit
+    reopen a fresh file.
+    """
+    rotated_path = LOG_FILE_PATH.with_suffix('.log.rotated')
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler) and handler.baseFilename == str(LOG_FILE_PATH):
+            handler.acquire()
+            try:
+                handler.close()
+                if LOG_FILE_PATH.exists():
+                    os.replace(LOG_FILE_PATH, rotated_path)
+            finally:
+                handler.release()
+            return rotated_path if rotated_path.exists() else None
+    return None
+
+_last_saved_state_bytes = None
 
 def save_state(data):
+    global _last_saved_state_bytes
+    serialized = _json_dumps_bytes(data)
+    # Most cycles change nothing; don't rewrite and fsync an identical file.
+    if serialized == _last_saved_state_bytes: return
     STATES_DIR.mkdir(parents=True, exist_ok=True)
-    with open(STATE_FILE, 'w') as f: json.dump(data, f, indent=2)
+    # Write-then-rename keeps the state file crash-atomic: a kill mid-write
+    # can no longer leave a truncated file that forces a full rescan.
+    tmp_path = STATE_FILE.with_suffix('.json.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(serialized)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, STATE_FILE)
+    _last_saved_state_bytes = serialized
     logging.info(f"State saved successfully.")
 
 def load_state():
     if not STATE_FILE.exists(): return {}
     try:
-        with open(STATE_FILE, 'r') as f: return json.load(f)
+        with open(STATE_FILE, 'rb') as f: return _json_loads(f.read())
     except Exception: return {}
 
 def check_for_new_report_and_trigger(session, state, full_run=False):
     logging.info("Checking for new report file...")
-    ntblm_folder = find_drive_item_by_name(session, UPLOAD_FOLDER_NAME, drive_id=NTBLM_DRIVE_ID)
-    if not ntblm_folder: return state
+    ntblm_folder_id = get_upload_folder_id(session, state)
+    if not ntblm_folder_id: return state
 
-    reports_folder = find_drive_item_by_name(session, REPORTS_SUBFOLDER_NAME, parent_id=ntblm_folder['id'], drive_id=NTBLM_DRIVE_ID)
+    reports_folder = find_drive_item_by_name(session, REPORTS_SUBFOLDER_NAME, parent_id=ntblm_folder_id, drive_id=NTBLM_DRIVE_ID)
     if not reports_folder: return state
 
-    report_file_item = find_drive_item_by_name(session, ".xlsx", parent_id=reports_folder['id'], drive_id=NTBLM_DRIVE_ID, order_by="modifiedTime desc")
+    report_file_item = find_drive_item_by_name(session, ".xlsx", parent_id=reports_folder['id'], drive_id=NTBLM_DRIVE_ID, order_by="modifiedTime desc", contains=True)
     if not report_file_item: return state
 
     last_known_mod_time = state.get("last_report_modified_time")
@@ -230,99 +629,280 @@ def check_for_new_report_and_trigger(session, state, full_run=False):
         trigger_reason = "Full run requested" if full_run else f"New report file detected (Modified: {current_mod_time})"
         logging.info(f"{trigger_reason}. Triggering other scripts.")
         
-        full_run_flag = "--full-run" if full_run else ""
-        # The following lines are commented out as per the user's request.
-        # os.system(f"{sys.executable} {BASE_DIR / 'report_matcher.py'} {full_run_flag}")
-        # os.system(f"{sys.executable} {BASE_DIR / 'preparation_planner.py'} {full_run_flag}")
-        
+        # Downstream triggers remain disabled as per the user's request.
+        # trigger_downstream_scripts(full_run=full_run)
+
         state["last_report_modified_time"] = current_mod_time
     else:
         logging.info("Report file has not changed.")
     
     return state
 
-def run_full_scan_workflow(session, full_run=False):
+def run_full_scan_workflow(session, full_run=False, state=None):
     logging.info("Starting FULL scan workflow...")
-    root_meta = get_item_metadata(session, DRIVE_FOLDER_ID)
+    # A full scan recomputes every path; cached ones may be stale. Drop the
+    # on-disk copy too, or the next patch cycle just reloads the stale entries.
+    _shared_path_cache.clear()
+    PATH_CACHE_FILE.unlink(missing_ok=True)
+    root_meta = get_item_metadata(session, DRIVE_FOLDER_ID, fields="id,name,mimeType,parents,driveId")
     if not root_meta: return False
     scan_results = [{**root_meta, 'path': root_meta.get('name', 'ROOT'), 'indent': -1}]
-    scan_results.extend(_perform_scan(session, DRIVE_FOLDER_ID, scan_results[0]['path'], -1))
-    scan_results.sort(key=lambda x: x['path'])
+    # _perform_scan emits depth-ordered output; every consumer either indexes
+    # by id or re-sorts by path itself, so no full path sort is needed here.
+    scan_results.extend(_perform_scan(session, DRIVE_FOLDER_ID, scan_results[0]['path'], -1, root_meta.get('driveId')))
     logging.info(f"Full scan complete. Found {len(scan_results)} items.")
     TEMP_DIR.mkdir(exist_ok=True)
     local_scan_path = TEMP_DIR / "drive_scan.jsonl"
-    with open(local_scan_path, 'w', encoding='utf-8') as f:
-        f.write("\n".join([json.dumps(item, ensure_ascii=False) for item in scan_results]))
-    
-    upload_folder = find_drive_item_by_name(session, UPLOAD_FOLDER_NAME, drive_id=NTBLM_DRIVE_ID)
-    if upload_folder:
-        backup_and_upload(session, local_scan_path, upload_folder['id'], NTBLM_DRIVE_ID, "drive_scan.jsonl", "drive_scan_last_run.jsonl")
+    # A 1 MiB buffer batches the per-item writes into few syscalls.
+    with open(local_scan_path, 'wb', buffering=1 << 20) as f:
+        for item in scan_results:
+            f.write(_json_dumps_bytes(item) + b"\n")
+
+    upload_folder_id = get_upload_folder_id(session, state)
+    if upload_folder_id:
+        if backup_and_upload(session, local_scan_path, upload_folder_id, NTBLM_DRIVE_ID, "drive_scan.jsonl", "drive_scan_last_run.jsonl"):
+            if state is not None:
+                # Record the uploaded snapshot's timestamp so the next patch
+                # cycle trusts its local copy instead of re-downloading it.
+                uploaded_item = find_drive_item_by_name(session, "drive_scan.jsonl", parent_id=upload_folder_id, drive_id=NTBLM_DRIVE_ID)
+                if uploaded_item:
+                    state["scan_file_modified_time"] = uploaded_item.get('modifiedTime')
+        else:
+            # The cached folder ID is the likeliest stale piece; re-resolve next cycle.
+            _invalidate_upload_folder(state)
+        # The fresh snapshot supersedes any accumulated patch log.
+        local_patch_path = TEMP_DIR / SCAN_PATCH_FILENAME
+        if local_patch_path.exists(): local_patch_path.write_bytes(b"")
+        stale_patch = find_drive_item_by_name(session, SCAN_PATCH_FILENAME, parent_id=upload_folder_id, drive_id=NTBLM_DRIVE_ID)
+        if stale_patch:
+            try:
+                session.delete(f"{DRIVE_API_V3_URL}/files/{stale_patch['id']}", params={'supportsAllDrives': 'true'}).raise_for_status()
+                _invalidate_find_cache(name=SCAN_PATCH_FILENAME, parent_id=upload_folder_id)
+            except Exception as e:
+                logging.warning(f"Could not delete stale patch log: {e}")
         logging.info("Full scan complete. Downstream script triggers are now disabled.")
         
-        full_run_flag = "--full-run" if full_run else ""
-        # The following lines are commented out as per the user's request.
-        # os.system(f"{sys.executable} {BASE_DIR / 'report_matcher.py'} {full_run_flag}")
-        # os.system(f"{sys.executable} {BASE_DIR / 'preparation_planner.py'} {full_run_flag}")
+        # Downstream triggers remain disabled as per the user's request.
+        # trigger_downstream_scripts(full_run=full_run)
     else:
         logging.error(f"Could not find the upload folder '{UPLOAD_FOLDER_NAME}' in the specified NTBLM drive.")
 
     logging.info("FULL scan workflow complete.")
     return True
 
-def run_patch_workflow(session, changes):
+def upload_or_overwrite_file(session, local_path, folder_id, drive_id, drive_filename):
+    if not local_path.exists():
+        return True
+    try:
+        existing_file = find_drive_item_by_name(session, drive_filename, parent_id=folder_id, drive_id=drive_id)
+        if existing_file:
+            session.delete(f"{DRIVE_API_V3_URL}/files/{existing_file['id']}", params={'supportsAllDrives': 'true'}).raise_for_status()
+        file_metadata = {'name': drive_filename, 'parents': [folder_id]}
+        with open(local_path, 'rb') as f:
+            files = {'data': ('metadata', json.dumps(file_metadata), 'application/json'), 'file': f}
+            session.post(f"https://www.googleapis.com/upload/drive/v3/files", params={'uploadType': 'multipart', 'supportsAllDrives': 'true'}, files=files).raise_for_status()
+        _invalidate_find_cache(name=drive_filename, parent_id=folder_id)
+        logging.info(f"Successfully uploaded '{drive_filename}'.")
+        return True
+    except Exception as e:
+        logging.error(f"Upload/overwrite failed for '{drive_filename}': {e}")
+        return False
+
+def apply_scan_patch_event(cache_by_id, event):
+    """Applies one event from the append-only scan patch log to the id index."""
+    if event.get('op') == 'delete':
+        cache_by_id.pop(event.get('id'), None)
+    elif event.get('op') == 'upsert':
+        item = event.get('item')
+        if item and item.get('id'): cache_by_id[item['id']] = item
+
+def _download_and_index_scan(session, file_id, destination_path):
+    """Streams the scan JSONL to disk while building the id index in the same pass."""
+    cache_by_id, root_name = {}, "ROOT"
+    response = session.get(f"{DRIVE_API_V3_URL}/files/{file_id}?alt=media", params={'supportsAllDrives': 'true'}, stream=True)
+    response.raise_for_status()
+    with open(destination_path, 'wb') as f:
+        for line in response.iter_lines():
+            if not line: continue
+            f.write(line + b"\n")
+            item = _json_loads(line)
+            cache_by_id[item['id']] = item
+            if item['id'] == DRIVE_FOLDER_ID: root_name = item['name']
+    return cache_by_id, root_name
+
+def run_patch_workflow(session, changes, state):
     logging.info(f"Starting PATCH update workflow for {len(changes)} changes...")
     try:
-        upload_folder = find_drive_item_by_name(session, UPLOAD_FOLDER_NAME, drive_id=NTBLM_DRIVE_ID)
-        if not upload_folder: return run_full_scan_workflow(session)
-
-        scan_file_item = find_drive_item_by_name(session, "drive_scan.jsonl", parent_id=upload_folder['id'], drive_id=NTBLM_DRIVE_ID) or \
-                         find_drive_item_by_name(session, "drive_scan_last_run.jsonl", parent_id=upload_folder['id'], drive_id=NTBLM_DRIVE_ID)
-        if not scan_file_item: return run_full_scan_workflow(session)
+        # Drive often reports several events for the same file in one polling
+        # window (e.g. create then rename); only the last one matters, so
+        # coalesce before paying per-change work.
+        coalesced = {}
+        for n, change in enumerate(changes):
+            coalesced[change.get('fileId') or n] = change
+        if len(coalesced) < len(changes):
+            logging.info(f"Coalesced {len(changes)} change events into {len(coalesced)}.")
+            changes = list(coalesced.values())
+
+        upload_folder_id = get_upload_folder_id(session, state)
+        if not upload_folder_id: return run_full_scan_workflow(session, state=state)
+
+        scan_file_item = find_drive_item_by_name(session, "drive_scan.jsonl", parent_id=upload_folder_id, drive_id=NTBLM_DRIVE_ID) or \
+                         find_drive_item_by_name(session, "drive_scan_last_run.jsonl", parent_id=upload_folder_id, drive_id=NTBLM_DRIVE_ID)
+        if not scan_file_item:
+            # No scan files under the cached folder usually means the ID went
+            # stale; drop it so the full scan re-resolves instead of looping.
+            _invalidate_upload_folder(state)
+            return run_full_scan_workflow(session, state=state)
         
         local_scan_path = TEMP_DIR / "drive_scan.jsonl"
-        download_file(session, scan_file_item['id'], local_scan_path)
-        with open(local_scan_path, 'r', encoding='utf-8') as f: scan_cache = [json.loads(line) for line in f if line.strip()]
+        local_patch_path = TEMP_DIR / SCAN_PATCH_FILENAME
+        cache_pickle_path = TEMP_DIR / "cache_by_id.pkl"
+        cache_by_id, root_name = {}, "ROOT"
+        downloaded_snapshot = False
+        # The listener wrote this file itself last cycle; only re-download when the
+        # local copy is missing or Drive reports a different modifiedTime. A needed
+        # download streams straight into the index, so the file is never read twice.
+        remote_mod_time = scan_file_item.get('modifiedTime')
+        if not local_scan_path.exists() or remote_mod_time != state.get("scan_file_modified_time"):
+            cache_by_id, root_name = _download_and_index_scan(session, scan_file_item['id'], local_scan_path)
+            downloaded_snapshot = True
+            # Remember what we just downloaded, or every following cycle
+            # re-downloads the snapshot until the next compaction.
+            state["scan_file_modified_time"] = remote_mod_time
+            # The Drive snapshot only captures the last compaction; replay the
+            # remote patch log on top of it to catch up.
+            remote_patch = find_drive_item_by_name(session, SCAN_PATCH_FILENAME, parent_id=upload_folder_id, drive_id=NTBLM_DRIVE_ID)
+            if remote_patch and download_file(session, remote_patch['id'], local_patch_path, size=int(remote_patch.get('size') or 0)):
+                with open(local_patch_path, 'rb') as f:
+                    for line in f:
+                        if line.strip(): apply_scan_patch_event(cache_by_id, _json_loads(line))
+            elif local_patch_path.exists():
+                local_patch_path.unlink()
+        # Prefer the sidecar pickle of the id index when it is at least as new
+        # as the JSONL; reparsing the whole scan every cycle is wasted CPU.
+        if not cache_by_id and cache_pickle_path.exists() and cache_pickle_path.stat().st_mtime >= local_scan_path.stat().st_mtime:
+            try:
+                with open(cache_pickle_path, 'rb') as f: cache_by_id = pickle.load(f)
+                root_item = cache_by_id.get(DRIVE_FOLDER_ID)
+                if root_item: root_name = root_item['name']
+            except Exception as e:
+                logging.warning(f"Could not load scan index pickle, reparsing JSONL: {e}")
+                cache_by_id = {}
+        if not cache_by_id:
+            # Single streaming pass: build the id index line by line instead of
+            # materializing the whole scan twice (list + dict).
+            with open(local_scan_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip(): continue
+                    item = _json_loads(line)
+                    cache_by_id[item['id']] = item
+                    if item['id'] == DRIVE_FOLDER_ID: root_name = item['name']
+            if local_patch_path.exists():
+                with open(local_patch_path, 'rb') as f:
+                    for line in f:
+                        if line.strip(): apply_scan_patch_event(cache_by_id, _json_loads(line))
+        path_cache = _load_shared_path_cache()
+        path_cache[DRIVE_FOLDER_ID] = root_name
+        # Changed items may have been renamed or moved; drop their stale paths.
+        for change in changes:
+            path_cache.pop(change.get('fileId'), None)
+
+        # Resolve all unknown ancestors with batched files.get calls up front, so the
+        # per-change path assembly below needs no serial API round-trips.
+        # The scan cache already holds name+parents for every known item; layer
+        # the per-cycle fetches over it so only genuinely unknown ancestors
+        # (e.g. brand-new folders) cost an API call at all.
+        metadata_cache = ChainMap({}, cache_by_id)
+        parent_ids = set()
+        for c in changes:
+            file_data = c.get('file')
+            if c.get('fileId') and not c.get('removed') and file_data and file_data.get('parents'):
+                metadata_cache[c['fileId']] = {'id': c['fileId'], **file_data}
+                parent_ids.add(file_data['parents'][0])
+        prefetch_ancestors(session, parent_ids, path_cache, metadata_cache)
+
+        # Parent -> children adjacency built in one pass, so removing a folder
+        # drops its whole subtree in O(subtree) instead of leaving orphans or
+        # scanning every cached path per removal.
+        children_by_parent = defaultdict(list)
+        for cached_id, cached_item in cache_by_id.items():
+            cached_parents = cached_item.get('parents') or []
+            if cached_parents: children_by_parent[cached_parents[0]].append(cached_id)
+
+        # Every mutation this cycle is also recorded as an upsert/delete event,
+        # so only the small patch log has to be written and uploaded below.
+        events = []
+
+        def _remove_subtree(root_id):
+            stack = [root_id]
+            while stack:
+                node_id = stack.pop()
+                if cache_by_id.pop(node_id, None) is not None:
+                    events.append({'op': 'delete', 'id': node_id})
+                path_cache.pop(node_id, None)
+                stack.extend(children_by_parent.pop(node_id, ()))
 
-        cache_by_id = {item['id']: item for item in scan_cache}
-        root_name = next((item['name'] for item in scan_cache if item['id'] == DRIVE_FOLDER_ID), "ROOT")
-        path_cache = {DRIVE_FOLDER_ID: root_name}
-        
         for change in changes:
-            if change.get('changeType') == 'drive': return run_full_scan_workflow(session)
+            if change.get('changeType') == 'drive': return run_full_scan_workflow(session, state=state)
             file_id = change.get('fileId')
             if change.get('removed'):
-                if file_id in cache_by_id: del cache_by_id[file_id]
+                _remove_subtree(file_id)
                 continue
             file_data = change.get('file')
-            if not file_id or not file_data or not file_data.get('parents'): return run_full_scan_workflow(session)
-            new_path = get_full_path(session, file_id, path_cache, root_name)
-            new_indent = new_path.count('/') -1
-            cache_by_id[file_id] = {**file_data, 'path': new_path, 'indent': new_indent}
-
-        updated_scan_list = sorted(list(cache_by_id.values()), key=lambda x: x.get('path', ''))
-        with open(local_scan_path, 'w', encoding='utf-8') as f:
-            f.write("\n".join([json.dumps(item, ensure_ascii=False) for item in updated_scan_list]))
+            if not file_id or not file_data or not file_data.get('parents'): return run_full_scan_workflow(session, state=state)
+            new_path, new_indent = get_full_path(session, file_id, path_cache, root_name, metadata_cache)
+            # changes.list's file mask omits 'id'; patch consumers key on it.
+            cache_by_id[file_id] = {'id': file_id, **file_data, 'path': new_path, 'indent': new_indent}
+            events.append({'op': 'upsert', 'item': cache_by_id[file_id]})
+
+        with open(local_patch_path, 'ab') as f:
+            for event in events:
+                f.write(_json_dumps_bytes(event) + b"\n")
+        with open(cache_pickle_path, 'wb') as f:
+            pickle.dump(cache_by_id, f, protocol=5)
+        _save_shared_path_cache()
+
+        # Upload only the patch log each cycle; rewrite and re-upload the full
+        # snapshot only once the log has grown past PATCH_COMPACTION_RATIO of it.
+        snapshot_size = local_scan_path.stat().st_size if local_scan_path.exists() else 0
+        if not local_scan_path.exists() or local_patch_path.stat().st_size > snapshot_size * PATCH_COMPACTION_RATIO:
+            with open(local_scan_path, 'wb', buffering=1 << 20) as f:
+                # 'path' is always populated at insertion, so the C-level getter is safe.
+                for item in sorted(cache_by_id.values(), key=itemgetter('path')):
+                    f.write(_json_dumps_bytes(item) + b"\n")
+            if not backup_and_upload(session, local_scan_path, upload_folder_id, NTBLM_DRIVE_ID, "drive_scan.jsonl", "drive_scan_last_run.jsonl"):
+                _invalidate_upload_folder(state)
+            local_patch_path.write_bytes(b"")
+            stale_patch = find_drive_item_by_name(session, SCAN_PATCH_FILENAME, parent_id=upload_folder_id, drive_id=NTBLM_DRIVE_ID)
+            if stale_patch:
+                try:
+                    session.delete(f"{DRIVE_API_V3_URL}/files/{stale_patch['id']}", params={'supportsAllDrives': 'true'}).raise_for_status()
+                    _invalidate_find_cache(name=SCAN_PATCH_FILENAME, parent_id=upload_folder_id)
+                except Exception as e:
+                    logging.warning(f"Could not delete stale patch log: {e}")
+            uploaded_item = find_drive_item_by_name(session, "drive_scan.jsonl", parent_id=upload_folder_id, drive_id=NTBLM_DRIVE_ID)
+            if uploaded_item:
+                state["scan_file_modified_time"] = uploaded_item.get('modifiedTime')
+        elif events or downloaded_snapshot:
+            if not upload_or_overwrite_file(session, local_patch_path, upload_folder_id, NTBLM_DRIVE_ID, SCAN_PATCH_FILENAME):
+                _invalidate_upload_folder(state)
 
-        backup_and_upload(session, local_scan_path, upload_folder['id'], NTBLM_DRIVE_ID, "drive_scan.jsonl", "drive_scan_last_run.jsonl")
-        
         logging.info("Client folder changes detected. Downstream script triggers are now disabled.")
-        # The following line is commented out as per the user's request.
-        # os.system(f"{sys.executable} {BASE_DIR / 'preparation_planner.py'}")
-        
+        # Downstream trigger remains disabled as per the user's request.
+        # trigger_downstream_scripts(include_matcher=False)
+
         return True
     except Exception as e:
         logging.error(f"Error during PATCH workflow: {e}. Falling back to full scan.")
-        return run_full_scan_workflow(session)
+        _invalidate_upload_folder(state)  # The cached folder ID may be the stale piece.
+        return run_full_scan_workflow(session, state=state)
 
 def main(args):
-    session = AuthorizedSession(get_credentials())
-    adapter = HTTPAdapter(pool_connections=100, pool_maxsize=100, max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 503]))
-    session.mount("https://", adapter)
-    
-    ntblm_folder_id, logs_folder_id = None, None
-    ntblm_folder = find_drive_item_by_name(session, UPLOAD_FOLDER_NAME, drive_id=NTBLM_DRIVE_ID)
-    if ntblm_folder:
-        ntblm_folder_id = ntblm_folder['id']
+    session = build_session()
+
+    logs_folder_id = None
+    ntblm_folder_id = get_upload_folder_id(session)
+    if ntblm_folder_id:
         logs_folder_id = find_or_create_folder(session, LOGS_SUBFOLDER_NAME, ntblm_folder_id, NTBLM_DRIVE_ID)
 
     if args.full_run:
@@ -341,7 +921,7 @@ def main(args):
     last_token, last_scan_timestamp = state.get("startPageToken"), state.get("last_full_scan_timestamp", 0)
 
     if args.full_run or not last_token:
-        if run_full_scan_workflow(session, full_run=args.full_run):
+        if run_full_scan_workflow(session, full_run=args.full_run, state=state):
             last_token = get_start_page_token(session, DRIVE_FOLDER_ID)
             state["startPageToken"] = last_token
             state["last_full_scan_timestamp"] = time.time()
@@ -357,28 +937,31 @@ def main(args):
             state = check_for_new_report_and_trigger(session, state)
             
             if (time.time() - state.get("last_full_scan_timestamp", 0)) > (SCHEDULED_RESCAN_HOURS * 3600):
-                if run_full_scan_workflow(session):
+                if run_full_scan_workflow(session, state=state):
                     state["startPageToken"] = get_start_page_token(session, DRIVE_FOLDER_ID)
                     state["last_full_scan_timestamp"] = time.time()
             else:
-                changes, new_token = list_changes(session, state.get("startPageToken"), DRIVE_FOLDER_ID)
+                changes, new_token, changes_etag = list_changes(session, state.get("startPageToken"), DRIVE_FOLDER_ID, state.get("changes_etag"))
                 if new_token is None:
                     logging.warning("Failed to get new page token. Retrying in 1 hour.")
                     time.sleep(3600); continue
+                state["changes_etag"] = changes_etag
                 if changes:
-                    if run_patch_workflow(session, changes):
+                    if run_patch_workflow(session, changes, state):
                         state["startPageToken"] = new_token
                 else:
                     logging.info("No changes detected in main drive.")
                     state["startPageToken"] = new_token
             
             save_state(state)
-            
+            save_token_cache(session.credentials)
+
             if logs_folder_id:
                 logging.info("Uploading current log file...")
-                backup_and_upload(session, LOG_FILE_PATH, logs_folder_id, NTBLM_DRIVE_ID, f"{APP_NAME}.log", f"{APP_NAME}_last_run.log")
-                if LOG_FILE_PATH.exists():
-                    open(LOG_FILE_PATH, 'w').close()
+                rotated_log = rotate_log_file()
+                if rotated_log:
+                    backup_and_upload(session, rotated_log, logs_folder_id, NTBLM_DRIVE_ID, f"{APP_NAME}.log", f"{APP_NAME}_last_run.log")
+                    rotated_log.unlink(missing_ok=True)
 
             logging.info(f"Sleeping for {POLLING_INTERVAL_SECONDS} seconds.")
             time.sleep(POLLING_INTERVAL_SECONDS)
@@ -11,8 +11,12 @@ import shutil
 from datetime import datetime
 import concurrent.futures
 import multiprocessing
+from email.parser import BytesParser
 import subprocess
-import io
+import functools
+import threading
+import zipfile
+import xml.etree.ElementTree as ElementTree
 from zipfile import BadZipFile
 from decimal import Decimal
 import signal
@@ -20,19 +24,39 @@ import signal
 import requests
 from dotenv import load_dotenv
 from google.oauth2 import service_account
+
+# orjson is ~3-10x faster than stdlib json for plan files and Drive replies;
+# fall back if absent.
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    _json_loads = json.loads
 from google.auth.transport.requests import AuthorizedSession
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+# Tesseract's OpenMP threading contends with our own thread/process pools and
+# slows per-image throughput; pin it to one thread before any tesseract spawn.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 # --- Conversion and processing libraries ---
-import pandas as pd
 from PyPDF2 import PdfReader, PdfWriter
+# pikepdf (qpdf in C++) merges and overlays by reference instead of re-parsing
+# every stream in Python; PyPDF2 is the fallback.
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
 import pytesseract
-from PIL import Image
-import docx
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import inch
-from reportlab.lib.colors import Color
+# tesserocr keeps the LSTM model resident in-process instead of forking a
+# fresh tesseract subprocess per file; the pytesseract CLI is the fallback.
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+from PIL import Image, ImageOps
 
 # --- Basic Configuration ---
 APP_NAME = "FileProcessor"
@@ -66,23 +90,38 @@ LOGS_SUBFOLDER_NAME = "Logs"
 PLANS_SUBFOLDER_NAME = "PreparationPlans"
 CLIENTS_OUTPUT_SUBFOLDER_NAME = "Clients"
 DRIVE_API_V3_URL = "https://www.googleapis.com/drive/v3"
+# Hoisted once; the helpers below hit these on every one of the thousands of
+# Drive calls a large client generates.
+_FILES_URL = f"{DRIVE_API_V3_URL}/files"
+_UPLOAD_FILES_URL = "https://www.googleapis.com/upload/drive/v3/files"
+_ALL_DRIVES = {'supportsAllDrives': 'true'}
+_LIST_PARAMS_BASE = {'fields': 'files(id, name)', 'supportsAllDrives': True, 'includeItemsFromAllDrives': True}
 MAX_CONCURRENT_CLIENTS = 2
 MAX_DOWNLOAD_WORKERS = 10
+# CPU stage workers per client; split the machine between concurrent clients.
+MAX_CPU_WORKERS = max(1, (os.cpu_count() or 4) // MAX_CONCURRENT_CLIENTS)
+# OEM 1 = LSTM engine, PSM 6 = single uniform block: the fastest correct mode
+# for typical document scans. Point TESSDATA_FAST_DIR (.env) at a
+# tessdata_fast install to use the ~4x faster LSTM models; accuracy there is
+# plenty for bulk NotebookLM ingestion.
+TESSDATA_FAST_DIR = os.getenv('TESSDATA_FAST_DIR')
+TESSERACT_CONFIG = '--oem 1 --psm 6' + (f' --tessdata-dir "{TESSDATA_FAST_DIR}"' if TESSDATA_FAST_DIR else '')
 
 # --- Global Pool for Signal Handling ---
 pool = None
 
 def signal_handler(sig, frame):
-    """Handles Ctrl+C to terminate the multiprocessing pool."""
+    """Handles Ctrl+C to stop the client worker pool."""
     global pool
-    logging.warning("Ctrl+C detected. Terminating all worker processes...")
+    logging.warning("Ctrl+C detected. Shutting down all worker processes...")
     if pool:
-        pool.terminate()
-        pool.join()
+        pool.shutdown(wait=False, cancel_futures=True)
     sys.exit(1)
 
 # --- Core Drive/Utility Functions ---
+@functools.lru_cache(maxsize=1)
 def get_credentials():
+    """Loads the service-account key once per process; refreshes reuse the object."""
     scopes = ['https://www.googleapis.com/auth/drive']
     try:
         return service_account.Credentials.from_service_account_file(str(SERVICE_ACCOUNT_KEY_PATH), scopes=scopes)
@@ -90,46 +129,150 @@ def get_credentials():
         logging.critical(f"Failed to load credentials: {e}", exc_info=True)
         sys.exit(1)
 
+_session = None
+
+def get_session():
+    """One pooled AuthorizedSession per process. Reusing TCP+TLS connections to
+    googleapis.com across tasks beats rebuilding pool and handshake per call;
+    worker processes each build their own lazily on first use."""
+    global _session
+    if _session is None:
+        _session = AuthorizedSession(get_credentials())
+        # Retry transient Drive errors on every verb we use; a failed task
+        # means re-downloading and re-OCRing the whole file, which costs far
+        # more than an honored Retry-After.
+        retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset({'GET', 'POST', 'PATCH', 'PUT', 'DELETE'}),
+                      respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=MAX_DOWNLOAD_WORKERS, pool_maxsize=MAX_DOWNLOAD_WORKERS * 2, max_retries=retry)
+        _session.mount("https://", adapter)
+    return _session
+
+# The same (name, parent) pairs are looked up many times per run (every upload
+# re-checks for an existing file); cache hits skip a full Drive list RTT.
+_find_cache = {}
+
+def _invalidate_find_cache(name=None, parent_id=None):
+    """Drops cached lookups matching name and/or parent_id after a mutation."""
+    for key in [k for k in _find_cache if (name is None or k[0] == name) and (parent_id is None or k[1] == parent_id)]:
+        del _find_cache[key]
+
 def find_drive_item(session, name, parent_id=None, drive_id=None, mime_type=None):
+    cache_key = (name, parent_id, drive_id, mime_type)
+    if cache_key in _find_cache: return _find_cache[cache_key]
     safe_name = name.replace("'", "\\'")
     query = f"name = '{safe_name}' and trashed = false"
     if parent_id: query += f" and '{parent_id}' in parents"
     if mime_type: query += f" and mimeType = '{mime_type}'"
-    
-    params = {'q': query, 'fields': 'files(id, name)', 'supportsAllDrives': True, 'includeItemsFromAllDrives': True}
+
+    params = {**_LIST_PARAMS_BASE, 'q': query}
     if drive_id: params['driveId'] = drive_id; params['corpora'] = 'drive'
-    
+
     try:
-        response = session.get(f"{DRIVE_API_V3_URL}/files", params=params)
+        response = session.get(_FILES_URL, params=params)
         response.raise_for_status()
-        files = response.json().get('files', [])
-        return files[0] if files else None
+        files = _json_loads(response.content).get('files', [])
+        result = files[0] if files else None
+        _find_cache[cache_key] = result  # not-found is cached too; errors are not
+        return result
     except Exception:
         return None
 
+def find_drive_items_bulk(session, names, parent_id, drive_id=None):
+    """Resolves many names under one parent with a single files.list query.
+
+    OR-combining the names collapses N existence checks into one RTT per 50
+    names. Every name (found or not) is seeded into _find_cache, so later
+    find_drive_item calls for the same names cost nothing.
+    """
+    results = {}
+    names = list(dict.fromkeys(names))
+    for i in range(0, len(names), 50):  # keeps the q string well under Drive's query-length limit
+        chunk = names[i:i + 50]
+        clause = " or ".join("name = '{}'".format(n.replace("'", "\\'")) for n in chunk)
+        query = f"({clause}) and '{parent_id}' in parents and trashed = false"
+        params = {**_LIST_PARAMS_BASE, 'q': query, 'pageSize': len(chunk)}
+        if drive_id: params['driveId'] = drive_id; params['corpora'] = 'drive'
+        try:
+            response = session.get(_FILES_URL, params=params)
+            response.raise_for_status()
+            found = {f['name']: f for f in _json_loads(response.content).get('files', [])}
+        except Exception as e:
+            logging.error(f"Bulk name lookup failed for {len(chunk)} names: {e}")
+            continue
+        for n in chunk:
+            results[n] = found.get(n)
+            _find_cache[(n, parent_id, drive_id, None)] = found.get(n)
+    return results
+
 def find_or_create_folder(session, folder_name, parent_id, drive_id):
     folder = find_drive_item(session, folder_name, parent_id=parent_id, drive_id=drive_id)
     if folder: return folder['id']
     try:
         file_metadata = {'name': folder_name, 'mimeType': 'application/vnd.google-apps.folder', 'parents': [parent_id]}
-        response = session.post(f"{DRIVE_API_V3_URL}/files", json=file_metadata, params={'supportsAllDrives': 'true'})
+        response = session.post(_FILES_URL, json=file_metadata, params=_ALL_DRIVES)
         response.raise_for_status()
         logging.info(f"Created folder '{folder_name}'.")
+        _invalidate_find_cache(name=folder_name, parent_id=parent_id)
         return response.json()['id']
     except Exception as e:
         raise Exception(f"Failed to create folder '{folder_name}': {e}") from e
 
 def download_file(session, file_id, destination_path):
     try:
-        response = session.get(f"{DRIVE_API_V3_URL}/files/{file_id}?alt=media", params={'supportsAllDrives': 'true'}, stream=True)
+        response = session.get(f"{_FILES_URL}/{file_id}?alt=media", params=_ALL_DRIVES, stream=True)
         response.raise_for_status()
+        # Copy straight from the raw socket in 1 MiB blocks; the 8 KiB
+        # iter_content loop burned a Python iteration per few packets.
+        response.raw.decode_content = True
         with open(destination_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192): f.write(chunk)
+            shutil.copyfileobj(response.raw, f, length=1024 * 1024)
         return True
     except Exception as e:
         logging.error(f"FATAL: Failed to download file ID {file_id}: {e}")
         raise e
 
+RESUMABLE_UPLOAD_THRESHOLD_BYTES = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE_BYTES = 16 * 1024 * 1024
+
+def _upload_resumable(session, local_path, file_metadata):
+    """Drive resumable upload: initiate a session, then PUT chunks straight from disk.
+
+    Unlike the multipart path, this never materializes the whole file in memory.
+    """
+    total = local_path.stat().st_size
+    init = session.post(_UPLOAD_FILES_URL,
+                        params={'uploadType': 'resumable', **_ALL_DRIVES},
+                        json=file_metadata, headers={'X-Upload-Content-Length': str(total)})
+    init.raise_for_status()
+    upload_url = init.headers['Location']
+    response = None
+    with open(local_path, 'rb') as f:
+        sent = 0
+        while sent < total:
+            chunk = f.read(UPLOAD_CHUNK_SIZE_BYTES)
+            headers = {'Content-Length': str(len(chunk)), 'Content-Range': f'bytes {sent}-{sent + len(chunk) - 1}/{total}'}
+            response = session.put(upload_url, data=chunk, headers=headers)
+            if response.status_code == 308:
+                # 308 acks only the server-confirmed prefix, which can be short
+                # of what we sent; resume from its offset, not ours.
+                range_header = response.headers.get('Range', '')
+                confirmed = int(range_header.rsplit('-', 1)[-1]) + 1 if '-' in range_header else 0
+                if confirmed <= sent:
+                    raise Exception(f"Resumable upload of '{local_path.name}' made no progress at byte {sent}")
+                if confirmed != sent + len(chunk): f.seek(confirmed)
+                sent = confirmed
+                continue
+            if response.status_code not in (200, 201):
+                response.raise_for_status()
+            sent += len(chunk)
+    # Anything but a 200/201 here means Drive persisted fewer bytes than we
+    # sent; treating it as success would silently accept a truncated file.
+    if response is None or response.status_code not in (200, 201):
+        status = response.status_code if response is not None else 'no response'
+        raise Exception(f"Resumable upload of '{local_path.name}' ended with {status}; server confirmed {sent}/{total} bytes")
+    return response
+
 def upload_or_overwrite_file(session, local_path, folder_id, drive_id, drive_filename):
     if not local_path.exists() or local_path.stat().st_size == 0:
         logging.warning(f"Local file '{local_path.name}' is empty or missing. Skipping upload for '{drive_filename}'.")
@@ -137,44 +280,86 @@ def upload_or_overwrite_file(session, local_path, folder_id, drive_id, drive_fil
     try:
         existing_file = find_drive_item(session, drive_filename, parent_id=folder_id, drive_id=drive_id)
         if existing_file:
-            session.delete(f"{DRIVE_API_V3_URL}/files/{existing_file['id']}", params={'supportsAllDrives': 'true'}).raise_for_status()
+            session.delete(f"{_FILES_URL}/{existing_file['id']}", params=_ALL_DRIVES).raise_for_status()
 
         file_metadata = {'name': drive_filename, 'parents': [folder_id]}
-        with open(local_path, 'rb') as f:
-            files = {'data': ('metadata', json.dumps(file_metadata), 'application/json'), 'file': f}
-            response = session.post(f"https://www.googleapis.com/upload/drive/v3/files", params={'uploadType': 'multipart', 'supportsAllDrives': 'true'}, files=files)
-            response.raise_for_status()
+        # Concatenated batch PDFs can be large; stream those instead of letting
+        # requests assemble the whole multipart body in memory.
+        if local_path.stat().st_size >= RESUMABLE_UPLOAD_THRESHOLD_BYTES:
+            response = _upload_resumable(session, local_path, file_metadata)
+        else:
+            with open(local_path, 'rb') as f:
+                files = {'data': ('metadata', json.dumps(file_metadata), 'application/json'), 'file': f}
+                response = session.post(_UPLOAD_FILES_URL, params={'uploadType': 'multipart', **_ALL_DRIVES}, files=files)
+                response.raise_for_status()
+        _invalidate_find_cache(name=drive_filename, parent_id=folder_id)
         logging.info(f"Successfully uploaded '{drive_filename}'.")
         return response.json()
     except Exception as e:
         raise Exception(f"Upload/overwrite failed for '{drive_filename}': {e}") from e
 
+def batch_delete_files(session, file_ids):
+    """Deletes many files with one multipart/mixed batch request (100 per call)."""
+    file_ids = [fid for fid in file_ids if fid]
+    boundary = "file_processor_batch"
+    for i in range(0, len(file_ids), 100):
+        chunk = file_ids[i:i + 100]
+        parts = [f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <del{n}>\r\n\r\nDELETE /drive/v3/files/{fid}?supportsAllDrives=true HTTP/1.1\r\n\r\n" for n, fid in enumerate(chunk)]
+        body = "".join(parts) + f"--{boundary}--"
+        response = session.post("https://www.googleapis.com/batch/drive/v3", data=body, headers={'Content-Type': f'multipart/mixed; boundary={boundary}'})
+        response.raise_for_status()
+    logging.info(f"Batch-deleted {len(file_ids)} stale Drive files.")
+
+def batch_get_checksums(session, file_ids):
+    """Fetches md5Checksum for many file IDs with one multipart/mixed batch (100 per call)."""
+    results = {}
+    file_ids = [fid for fid in file_ids if fid]
+    boundary = "file_processor_batch"
+    for i in range(0, len(file_ids), 100):
+        chunk = file_ids[i:i + 100]
+        parts = [f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <md5{n}>\r\n\r\nGET /drive/v3/files/{fid}?fields=id,md5Checksum,size&supportsAllDrives=true HTTP/1.1\r\n\r\n" for n, fid in enumerate(chunk)]
+        body = "".join(parts) + f"--{boundary}--"
+        try:
+            response = session.post("https://www.googleapis.com/batch/drive/v3", data=body, headers={'Content-Type': f'multipart/mixed; boundary={boundary}'})
+            response.raise_for_status()
+            # Each part of the multipart/mixed reply wraps one embedded HTTP
+            # response whose body is the JSON metadata for a single file.
+            content_type = response.headers.get('Content-Type', 'multipart/mixed')
+            message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + response.content)
+            payloads = message.get_payload()
+            for part in (payloads if isinstance(payloads, list) else [payloads]):
+                raw = part.get_payload(decode=True)
+                if raw is None: raw = str(part.get_payload()).encode()
+                split = raw.split(b'\r\n\r\n', 1)
+                payload = split[1].strip() if len(split) == 2 else b''
+                if not payload.startswith(b'{'): continue
+                try:
+                    item = _json_loads(payload)
+                    # Google-native docs carry no md5; those dedupe by id instead.
+                    if item.get('md5Checksum'): results[item['id']] = item['md5Checksum']
+                except Exception: continue
+        except Exception as e:
+            logging.warning(f"Checksum batch lookup failed; downloads will not be deduped: {e}")
+    return results
+
 def copy_drive_file(session, source_file_id, new_name, target_folder_id):
     try:
         existing_file = find_drive_item(session, new_name, parent_id=target_folder_id, drive_id=NTBLM_DRIVE_ID)
         if existing_file:
-            session.delete(f"{DRIVE_API_V3_URL}/files/{existing_file['id']}", params={'supportsAllDrives': 'true'}).raise_for_status()
+            session.delete(f"{_FILES_URL}/{existing_file['id']}", params=_ALL_DRIVES).raise_for_status()
 
         file_metadata = {'name': new_name, 'parents': [target_folder_id]}
-        response = session.post(f"{DRIVE_API_V3_URL}/files/{source_file_id}/copy", json=file_metadata, params={'supportsAllDrives': 'true'})
+        response = session.post(f"{_FILES_URL}/{source_file_id}/copy", json=file_metadata, params=_ALL_DRIVES)
         response.raise_for_status()
+        _invalidate_find_cache(name=new_name, parent_id=target_folder_id)
         logging.info(f"Successfully copied plan to baseline '{new_name}'.")
         return response.json()
     except Exception as e:
         raise Exception(f"Failed to copy file to '{new_name}': {e}") from e
 
-def create_watermark(page_width, page_height, text_lines):
-    packet = io.BytesIO()
-    can = canvas.Canvas(packet, pagesize=(float(page_width), float(page_height)))
-    can.setFillColor(Color(0.8, 0.8, 0.8, alpha=0.5))
-    can.setFont("Helvetica", 8)
-    y_position = float(page_height) - 0.25 * inch
-    for line in text_lines:
-        can.drawString(0.25 * inch, y_position, line)
-        y_position -= 10
-    can.save()
-    packet.seek(0)
-    return PdfReader(packet)
+def provenance_title(task_info):
+    """Outline-entry text carrying the provenance that used to be stamped on pages."""
+    return f"{task_info['source_file_name']} | {task_info['source_file_path']} | {task_info['drive_link']}"
 
 def convert_with_libreoffice(input_path: Path, output_dir: Path, convert_to: str = 'pdf'):
     if not shutil.which("libreoffice"):
@@ -186,87 +371,213 @@ def convert_with_libreoffice(input_path: Path, output_dir: Path, convert_to: str
             "libreoffice", "--headless", "--convert-to", convert_to,
             "--outdir", str(output_dir), str(input_path)
         ]
-        result = subprocess.run(command, capture_output=True, text=True, timeout=300)
-        
-        if result.returncode != 0:
-            raise Exception(f"LibreOffice conversion failed for {input_path.name}. Error: {result.stderr}")
-
-        expected_output = output_dir / f"{input_path.stem}.{convert_to}"
+        # stdout is progress noise we never read on success; only stderr is
+        # kept, and only surfaced when the conversion fails.
+        subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE, timeout=300, check=True)
+
+        # convert_to may be a full LO filter spec like 'txt:Text (encoded):UTF8';
+        # the produced extension is everything before the first colon.
+        expected_output = output_dir / f"{input_path.stem}.{convert_to.split(':', 1)[0]}"
         if expected_output.exists():
             return expected_output
         raise FileNotFoundError(f"LibreOffice seemed to succeed but output file was not found: {expected_output}")
+    except subprocess.CalledProcessError as e:
+        raise Exception(f"LibreOffice conversion failed for {input_path.name}. Error: {e.stderr.decode(errors='ignore')}") from e
     except Exception as e:
         raise e
 
+OCR_MAX_LONG_EDGE_PX = 2200  # ~300dpi for a letter page; more pixels just cost time.
+
+def preprocess_for_ocr(input_path: Path):
+    """Grayscales, autocontrasts, binarizes and caps the resolution of an image
+    so Tesseract skips most of its internal Leptonica preprocessing."""
+    try:
+        with Image.open(input_path) as image:
+            image = ImageOps.autocontrast(image.convert('L'))
+            if max(image.size) > OCR_MAX_LONG_EDGE_PX:
+                scale = OCR_MAX_LONG_EDGE_PX / max(image.size)
+                image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+            return image.point(lambda p: 255 if p > 128 else 0, '1')
+    except Exception as e:
+        logging.warning(f"Could not preprocess '{input_path.name}' for OCR, using the raw image: {e}")
+        return None
+
+_ocr_api_local = threading.local()
+
+def _get_ocr_api():
+    """One persistent tesserocr API per worker thread, so the LSTM model loads
+    once per thread instead of once per file."""
+    api = getattr(_ocr_api_local, 'api', None)
+    if api is None:
+        kwargs = {'lang': 'eng', 'oem': tesserocr.OEM.LSTM_ONLY, 'psm': tesserocr.PSM.SINGLE_BLOCK}
+        if TESSDATA_FAST_DIR: kwargs['path'] = TESSDATA_FAST_DIR
+        api = tesserocr.PyTessBaseAPI(**kwargs)
+        api.SetVariable("tessedit_create_pdf", "1")
+        _ocr_api_local.api = api
+    return api
+
 def perform_ocr(input_path: Path, output_pdf_path: Path):
     try:
-        pdf_data = pytesseract.image_to_pdf_or_hocr(str(input_path), extension='pdf')
+        preprocessed = preprocess_for_ocr(input_path)
+        if tesserocr is not None:
+            ocr_source = input_path
+            if preprocessed is not None:
+                ocr_source = output_pdf_path.with_suffix('.ocr.png')
+                preprocessed.save(ocr_source)
+            try:
+                # ProcessPages renders <outputbase>.pdf via tessedit_create_pdf.
+                _get_ocr_api().ProcessPages(str(output_pdf_path.with_suffix('')), str(ocr_source))
+            finally:
+                if ocr_source != input_path and ocr_source.exists(): ocr_source.unlink()
+            if output_pdf_path.exists(): return output_pdf_path
+            raise Exception("tesserocr produced no PDF output")
+        pdf_data = pytesseract.image_to_pdf_or_hocr(preprocessed or str(input_path), extension='pdf', config=TESSERACT_CONFIG)
         with open(output_pdf_path, 'w+b') as f:
             f.write(pdf_data) # type: ignore
         return output_pdf_path
     except Exception as e:
         raise Exception(f"OCR failed for {input_path.name}: {e}") from e
 
+DOCX_W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+def extract_docx_text(input_path: Path, output_txt_path: Path):
+    """Streams paragraph text straight out of word/document.xml.
+
+    A docx is just a zip; iterparse over the one XML entry writes text
+    incrementally instead of materializing python-docx's whole object model
+    plus a joined list of every paragraph string.
+    """
+    with zipfile.ZipFile(input_path) as archive, archive.open('word/document.xml') as doc_xml, \
+         open(output_txt_path, 'w', encoding='utf-8') as out:
+        first = True
+        for _, element in ElementTree.iterparse(doc_xml):
+            if element.tag == f'{DOCX_W_NS}p':
+                if not first: out.write('\n')
+                out.write(''.join(node.text or '' for node in element.iter(f'{DOCX_W_NS}t')))
+                first = False
+                element.clear()
+    return output_txt_path
+
 def concatenate_texts(tasks_with_paths: list[dict], output_path: Path):
     logging.info(f"Concatenating {len(tasks_with_paths)} text files...")
-    with open(output_path, 'w', encoding='utf-8') as outfile:
+    # CONVERT/OCR outputs are UTF-8 files we wrote ourselves and copy through
+    # as raw bytes; DIRECT_INCLUDE sources come from Drive in whatever
+    # encoding the client used, so those are transcoded to UTF-8 block-wise.
+    with open(output_path, 'wb') as outfile:
         for item in tasks_with_paths:
             fpath, task = item['path'], item['task']
-            outfile.write(f"\n--- START OF {task['source_file_name']} ---\n")
-            with open(fpath, 'r', encoding='utf-8', errors='ignore') as infile:
-                outfile.write(infile.read())
-            outfile.write(f"\n--- END OF {task['source_file_name']} ---\n\n")
+            outfile.write(f"\n--- START OF {task['source_file_name']} ---\n".encode('utf-8'))
+            if task.get('task_type') == 'DIRECT_INCLUDE':
+                with open(fpath, 'r', encoding='utf-8', errors='ignore') as infile:
+                    for block in iter(lambda: infile.read(1 << 20), ''):
+                        outfile.write(block.encode('utf-8'))
+            else:
+                with open(fpath, 'rb') as infile:
+                    shutil.copyfileobj(infile, outfile, length=1024 * 1024)
+            outfile.write(f"\n--- END OF {task['source_file_name']} ---\n\n".encode('utf-8'))
+    return output_path
+
+def _concatenate_pdfs_pikepdf(tasks_with_paths: list[dict], output_path: Path):
+    output, sources = pikepdf.Pdf.new(), []
+    try:
+        with output.open_outline() as outline:
+            for item in tasks_with_paths:
+                pdf_path, task_info = item['path'], item['task']
+                if not pdf_path.exists() or pdf_path.stat().st_size == 0: continue
+                try:
+                    src = pikepdf.Pdf.open(str(pdf_path))
+                    sources.append(src)
+                    first_page = len(output.pages)
+                    output.pages.extend(src.pages)
+                    outline.root.append(pikepdf.OutlineItem(provenance_title(task_info), first_page))
+                except Exception as page_error:
+                    logging.warning(f"Could not append {pdf_path.name}. Skipping file. Error: {page_error}")
+                    continue
+        # Object streams pack the merged object graph tighter: smaller output
+        # and less write I/O on multi-hundred-page batches.
+        output.save(str(output_path), object_stream_mode=pikepdf.ObjectStreamMode.generate)
+    finally:
+        for src in sources: src.close()
     return output_path
 
 def concatenate_pdfs(tasks_with_paths: list[dict], output_path: Path):
-    logging.info(f"Concatenating and watermarking {len(tasks_with_paths)} PDF files...")
+    # Provenance goes into one bookmark per source file instead of a rendered
+    # overlay per page: no per-page reportlab/merge work, and the OCR text
+    # layer reaches NotebookLM unpolluted by header strings.
+    logging.info(f"Concatenating {len(tasks_with_paths)} PDF files...")
+    if pikepdf is not None:
+        return _concatenate_pdfs_pikepdf(tasks_with_paths, output_path)
     pdf_writer = PdfWriter()
     for item in tasks_with_paths:
         pdf_path, task_info = item['path'], item['task']
         if not pdf_path.exists() or pdf_path.stat().st_size == 0: continue
         try:
             pdf_reader = PdfReader(str(pdf_path))
-            watermark_text = [f"Source Path: {task_info['source_file_path']}", f"Source URL: {task_info['drive_link']}"]
+            first_page = len(pdf_writer.pages)
             for page in pdf_reader.pages:
-                watermark_pdf = create_watermark(page.mediabox.width, page.mediabox.height, watermark_text)
-                page.merge_page(watermark_pdf.pages[0])
                 pdf_writer.add_page(page)
+            pdf_writer.add_outline_item(provenance_title(task_info), first_page)
         except Exception as page_error:
-            logging.warning(f"Could not process/watermark {pdf_path.name}. Skipping file. Error: {page_error}")
+            logging.warning(f"Could not append {pdf_path.name}. Skipping file. Error: {page_error}")
             continue
     with open(output_path, "wb") as out:
         pdf_writer.write(out)
     return output_path
 
-def process_single_task(task, session, client_temp_dir):
-    file_id, file_name, task_type = task['source_file_id'], task['source_file_name'], task['task_type']
+def fast_rmtree(root):
+    """Removes a temp tree with its top-level entries fanned across threads.
+
+    shutil.rmtree walks serially with one unlink+stat per entry; a client dir
+    can hold thousands of intermediates, and the syscalls release the GIL, so
+    parallel removal overlaps the metadata I/O.
+    """
+    entries = list(os.scandir(root))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, max(1, len(entries)))) as ex:
+        list(ex.map(lambda e: shutil.rmtree(e.path, ignore_errors=True) if e.is_dir(follow_symlinks=False) else os.unlink(e.path), entries))
+    os.rmdir(root)
+
+def download_task(task, session, client_temp_dir):
+    """I/O stage: fetches the source file into the client temp dir (threaded)."""
+    file_id, file_name = task['source_file_id'], task['source_file_name']
     input_path = client_temp_dir / f"{file_id}_{file_name}"
-    output_path = None
-    
-    logging.info(f"Starting task '{task_type}' for '{file_name}' (ID: {file_id}).")
     download_file(session, file_id, input_path)
+    return input_path
 
-    if task_type == "IGNORE": return None
+def run_cpu_task(task, input_path, client_temp_dir):
+    """CPU stage: OCR/convert on an already-downloaded file; needs no Drive
+    access, so it can run in a worker process."""
+    file_id, file_name, task_type = task['source_file_id'], task['source_file_name'], task['task_type']
+    output_path = None
+
+    logging.info(f"Starting task '{task_type}' for '{file_name}' (ID: {file_id}).")
     if task_type == "DIRECT_INCLUDE": output_path = input_path
     elif task_type == "OCR": output_path = perform_ocr(input_path, client_temp_dir / f"{file_id}.pdf")
     elif task_type == "CONVERT":
         output_txt_path = client_temp_dir / f"{file_id}.txt"
         try:
-            doc = docx.Document(input_path)
-            with open(output_txt_path, 'w', encoding='utf-8') as f:
-                f.write('\n'.join([para.text for para in doc.paragraphs]))
+            extract_docx_text(input_path, output_txt_path)
             output_path = output_txt_path
         except (BadZipFile, Exception):
-            logging.warning(f"python-docx failed for '{file_name}'. Falling back to LibreOffice.")
-            converted_pdf = convert_with_libreoffice(input_path, client_temp_dir)
-            if converted_pdf:
-                reader = PdfReader(converted_pdf)
-                text = "".join(page.extract_text() for page in reader.pages if page.extract_text())
-                with open(output_txt_path, 'w', encoding='utf-8') as f: f.write(text)
-                output_path = output_txt_path
+            logging.warning(f"docx extraction failed for '{file_name}'. Falling back to LibreOffice.")
+            if 'spreadsheet' in task.get('input_mime_type', ''):
+                # 'Text (encoded)' is a Writer-only filter; Calc inputs keep the
+                # PDF route so every sheet lands in the text, not just the active one.
+                converted_pdf = convert_with_libreoffice(input_path, client_temp_dir)
+                if converted_pdf:
+                    reader = PdfReader(converted_pdf)
+                    text = "".join(page.extract_text() for page in reader.pages if page.extract_text())
+                    with open(output_txt_path, 'w', encoding='utf-8') as f: f.write(text)
+                    output_path = output_txt_path
+            else:
+                # LO writes UTF-8 text in one shot; no PDF render + extract_text round-trip.
+                converted_txt = convert_with_libreoffice(input_path, client_temp_dir, convert_to='txt:Text (encoded):UTF8')
+                if converted_txt:
+                    converted_txt.rename(output_txt_path)
+                    output_path = output_txt_path
 
     if output_path and output_path.exists():
-        return {"task": task, "result_path": output_path}
+        return {"task": task, "path": output_path}
     
     raise Exception(f"Task '{task_type}' for '{file_name}' produced no output file.")
 
@@ -278,19 +589,40 @@ def process_client(plan_file_id, plan_data):
     try:
         logging.info(f"[{process_name}] Starting processing for client: {client_name}")
         
-        session = AuthorizedSession(get_credentials())
-        adapter = HTTPAdapter(pool_connections=150, pool_maxsize=150, max_retries=Retry(total=5, backoff_factor=1))
-        session.mount("https://", adapter)
-        
+        session = get_session()
+
         client_temp_dir = TEMP_DIR_BASE / f"{client_name.replace(' ', '_')}_{os.getpid()}"
         client_temp_dir.mkdir(parents=True, exist_ok=True)
 
-        tasks = plan_data.get('processing_tasks', [])
+        # IGNORE tasks produce nothing, so don't even download their sources.
+        tasks = [task for task in plan_data.get('processing_tasks', []) if task.get('task_type') != "IGNORE"]
         processed_tasks = {}
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
-            future_to_task = {executor.submit(process_single_task, task, session, client_temp_dir): task for task in tasks}
-            for future in concurrent.futures.as_completed(future_to_task):
+
+        # Clients often reference the same Drive binary from several plan
+        # entries; one batched metadata call resolves md5Checksum for every
+        # source, and duplicate content is hardlinked instead of re-downloaded.
+        checksums = batch_get_checksums(session, {task['source_file_id'] for task in tasks})
+        task_groups = {}
+        for task in tasks:
+            task_groups.setdefault(checksums.get(task['source_file_id'], task['source_file_id']), []).append(task)
+
+        # Downloads are I/O-bound and stay threaded; OCR/convert is CPU-bound
+        # and fans out across worker processes. The stages overlap: each file
+        # enters the CPU pool the moment its download lands, so the network
+        # and the cores are busy at the same time instead of in sequence.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as downloader, \
+             concurrent.futures.ProcessPoolExecutor(max_workers=MAX_CPU_WORKERS) as cpu_pool:
+            download_futures = {downloader.submit(download_task, group[0], session, client_temp_dir): group for group in task_groups.values()}
+            cpu_futures = {}
+            for future in concurrent.futures.as_completed(download_futures):
+                group = download_futures[future]
+                downloaded_path = future.result()
+                for task in group:
+                    input_path = client_temp_dir / f"{task['source_file_id']}_{task['source_file_name']}"
+                    if input_path != downloaded_path and not input_path.exists():
+                        os.link(downloaded_path, input_path)
+                    cpu_futures[cpu_pool.submit(run_cpu_task, task, input_path, client_temp_dir)] = task
+            for future in concurrent.futures.as_completed(cpu_futures):
                 result = future.result()
                 if result and isinstance(result, dict):
                     task_info = result.get("task")
@@ -305,6 +637,9 @@ def process_client(plan_file_id, plan_data):
         clients_folder = find_or_create_folder(session, CLIENTS_OUTPUT_SUBFOLDER_NAME, ntblm_folder['id'], NTBLM_DRIVE_ID)
         client_output_folder_id = find_or_create_folder(session, client_name, clients_folder, NTBLM_DRIVE_ID)
 
+        # Build every batch output locally first, then clear all stale Drive
+        # copies with one batch request instead of one delete RTT per upload.
+        outputs = []
         for file_type, batches in plan_data.get('concatenation_plan', {}).items():
             for i, batch in enumerate(batches):
                 tasks_with_paths = [processed_tasks[t['source_file_id']] for t in batch.get('source_tasks', []) if t.get('source_file_id') in processed_tasks]
@@ -312,11 +647,22 @@ def process_client(plan_file_id, plan_data):
 
                 output_filename = f"{client_name.replace(' ', '_')}_batch_{i+1}.{file_type}"
                 local_output_path = client_temp_dir / output_filename
-                
+
                 if file_type == 'pdf': concatenate_pdfs(tasks_with_paths, local_output_path)
                 elif file_type == 'txt': concatenate_texts(tasks_with_paths, local_output_path)
-                
-                upload_or_overwrite_file(session, local_output_path, client_output_folder_id, NTBLM_DRIVE_ID, output_filename)
+
+                outputs.append((local_output_path, output_filename))
+
+        existing_by_name = find_drive_items_bulk(session, [name for _, name in outputs], client_output_folder_id, NTBLM_DRIVE_ID)
+        stale_ids = [item['id'] for item in existing_by_name.values() if item]
+        if stale_ids:
+            batch_delete_files(session, stale_ids)
+            # Record the deletions so the uploads below skip their own find+delete.
+            for _, output_filename in outputs:
+                _find_cache[(output_filename, client_output_folder_id, NTBLM_DRIVE_ID, None)] = None
+
+        for local_output_path, output_filename in outputs:
+            upload_or_overwrite_file(session, local_output_path, client_output_folder_id, NTBLM_DRIVE_ID, output_filename)
 
         plans_folder = find_drive_item(session, PLANS_SUBFOLDER_NAME, parent_id=ntblm_folder['id'], drive_id=NTBLM_DRIVE_ID)
         if plans_folder:
@@ -329,7 +675,7 @@ def process_client(plan_file_id, plan_data):
         raise e
     finally:
         if client_temp_dir and client_temp_dir.exists():
-            shutil.rmtree(client_temp_dir)
+            fast_rmtree(client_temp_dir)
         logging.info(f"[{process_name}] Finished processing for client: {client_name}")
 
 def main(args):
@@ -339,20 +685,20 @@ def main(args):
     
     signal.signal(signal.SIGINT, signal_handler)
 
-    session = AuthorizedSession(get_credentials())
-    
+    session = get_session()
+
     ntblm_folder = find_drive_item(session, BASE_UPLOAD_FOLDER_NAME, drive_id=NTBLM_DRIVE_ID)
     if not ntblm_folder: return logging.critical("Base NTBLM folder not found.")
     plans_folder_id = find_or_create_folder(session, PLANS_SUBFOLDER_NAME, ntblm_folder['id'], NTBLM_DRIVE_ID)
     if not plans_folder_id: return logging.critical("Plans folder not found.")
     
-    response = session.get(f"{DRIVE_API_V3_URL}/files", params={
+    response = session.get(_FILES_URL, params={
+        **_LIST_PARAMS_BASE,
         'q': f"'{plans_folder_id}' in parents and name contains '_plan.json' and not name contains '_last_run' and not name contains '_last_processed'",
-        'fields': 'files(id, name)', 'supportsAllDrives': True, 'includeItemsFromAllDrives': True, 
         'corpora': 'drive', 'driveId': NTBLM_DRIVE_ID
-    }).json()
+    })
 
-    plans_to_process = response.get('files', [])
+    plans_to_process = _json_loads(response.content).get('files', [])
 
     if args.test_run:
         logging.warning(f"--- TEST RUN MODE: Processing only the first batch of up to {MAX_CONCURRENT_CLIENTS} clients. ---")
@@ -363,24 +709,28 @@ def main(args):
 
     logging.info(f"Found {len(plans_to_process)} client plans to process. Will run {MAX_CONCURRENT_CLIENTS} at a time.")
     
-    plan_queue = []
-    for plan_file in plans_to_process:
+    def fetch_plan(plan_file):
         local_plan_path = TEMP_DIR_BASE / plan_file['name']
-        try:
-            download_file(session, plan_file['id'], local_plan_path)
-            with open(local_plan_path, 'r', encoding='utf-8') as f:
-                plan_data = json.load(f)
-            plan_queue.append((plan_file['id'], plan_data))
-            local_plan_path.unlink()
-        except Exception as e:
-            logging.critical(f"Failed to download and prepare plan {plan_file['name']}. Stopping. Error: {e}")
-            sys.exit(1)
+        download_file(session, plan_file['id'], local_plan_path)
+        with open(local_plan_path, 'rb') as f:
+            plan_data = _json_loads(f.read())
+        local_plan_path.unlink()
+        return (plan_file['id'], plan_data)
+
+    # Plan files are independent; fetch them over pooled connections instead
+    # of one serial round-trip each.
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(plans_to_process), MAX_DOWNLOAD_WORKERS)) as executor:
+            plan_queue = list(executor.map(fetch_plan, plans_to_process))
+    except Exception as e:
+        logging.critical(f"Failed to download and prepare plans. Stopping. Error: {e}")
+        sys.exit(1)
 
-    with multiprocessing.Pool(processes=MAX_CONCURRENT_CLIENTS) as p:
-        pool = p
-        pool.starmap(process_client, plan_queue)
-        pool.close()
-        pool.join()
+    # ProcessPoolExecutor workers are non-daemonic, so each client process can
+    # run its own CPU worker pool (multiprocessing.Pool workers cannot).
+    with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_CONCURRENT_CLIENTS) as executor:
+        pool = executor
+        list(executor.map(process_client, *zip(*plan_queue)))
 
     logging.info(f"--- {APP_NAME} Finished ---")
 
@@ -396,4 +746,4 @@ if __name__ == "__main__":
         logging.critical(f"The script stopped due to a critical error in one of the worker processes.")
     finally:
         if TEMP_DIR_BASE.exists():
-            shutil.rmtree(TEMP_DIR_BASE)
\ No newline at end of file
+            fast_rmtree(TEMP_DIR_BASE)
\ No newline at end of file
@@ -3,6 +3,7 @@
 import os
 import sys
 import json
+import bisect
 import logging
 import argparse
 from pathlib import Path
@@ -105,6 +106,23 @@ def download_file(session, file_id, destination_path):
         return False
 
 
+def apply_scan_patch(session, scan_data, ntblm_folder_id):
+    """Applies the listener's append-only patch log on top of the snapshot, if one exists."""
+    patch_item = find_drive_item(session, "drive_scan_patch.jsonl", parent_id=ntblm_folder_id, drive_id=NTBLM_DRIVE_ID)
+    if not patch_item: return scan_data
+    local_patch_path = TEMP_DIR / "drive_scan_patch.jsonl"
+    if not download_file(session, patch_item['id'], local_patch_path): return scan_data
+    scan_by_id = {item['id']: item for item in scan_data}
+    with open(local_patch_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip(): continue
+            event = json.loads(line)
+            if event.get('op') == 'delete': scan_by_id.pop(event.get('id'), None)
+            elif event.get('op') == 'upsert' and event.get('item', {}).get('id'): scan_by_id[event['item']['id']] = event['item']
+    logging.info(f"Applied scan patch log on top of the snapshot ({len(scan_by_id)} items).")
+    return sorted(scan_by_id.values(), key=lambda item: item.get('path', ''))
+
+
 def backup_and_upload(session, local_path, folder_id, drive_id, current_filename, backup_filename):
     if not local_path.exists() or local_path.stat().st_size == 0:
         logging.info(f"Local file '{local_path.name}' is empty or missing. Skipping upload for '{current_filename}'.")
@@ -303,15 +321,30 @@ def plan_concatenation(tasks, last_run_plan=None):
     logging.info("Concatenation planning complete.")
     return dict(new_concatenation_plan)
 
+def build_path_index(scan_data):
+    """Path-sorted view of the scan so prefix scans become bisect range lookups."""
+    indexed = sorted(scan_data, key=lambda item: item.get('path', ''))
+    return [item.get('path', '') for item in indexed], indexed
+
+def items_under_path(paths, indexed, prefix):
+    results = []
+    for i in range(bisect.bisect_left(paths, prefix), len(paths)):
+        if not paths[i].startswith(prefix): break
+        results.append(indexed[i])
+    return results
+
 def get_client_file_signatures(scan_data, client_to_folders_map):
+    # One sorted index turns the per-client-folder O(N) startswith sweeps into
+    # O(log N + matches) range lookups.
+    paths, indexed = build_path_index(scan_data)
     client_signatures = {}
     for client_name, folder_info_list in client_to_folders_map.items():
         if not folder_info_list: continue
-        
+
         client_folder_paths = [f.get("path") for f in folder_info_list if f.get("path")]
         file_ids = set()
         for path in client_folder_paths:
-            file_ids.update({item['id'] for item in scan_data if item.get("path", "").startswith(path)})
+            file_ids.update(item['id'] for item in items_under_path(paths, indexed, path))
         client_signatures[client_name] = file_ids
     return client_signatures
 
@@ -402,7 +435,9 @@ def main(args):
         
         with open(local_matcher_path, 'r', encoding='utf-8') as f: matcher_data = json.load(f)
         with open(local_current_scan_path, 'r', encoding='utf-8') as f: current_scan_data = [json.loads(line) for line in f if line.strip()]
-        
+        current_scan_data = apply_scan_patch(session, current_scan_data, ntblm_folder['id'])
+        scan_paths, scan_items_sorted = build_path_index(current_scan_data)
+
         last_run_scan_data = []
         if not args.full_run and last_run_scan_item and download_file(session, last_run_scan_item['id'], local_last_scan_path):
             with open(local_last_scan_path, 'r', encoding='utf-8') as f:
@@ -468,7 +503,7 @@ def main(args):
             
             # --- Generate the new plan ---
             client_folder_paths = [f.get("path") for f in client_folder_info_list if f.get("path")]
-            client_files = [item for path in client_folder_paths for item in current_scan_data if item.get("path", "").startswith(path)]
+            client_files = [item for path in client_folder_paths for item in items_under_path(scan_paths, scan_items_sorted, path)]
             client_files = list({f['id']: f for f in client_files}.values())
             for file_info in client_files:
                 file_info["client_master_name"] = client_name
@@ -513,6 +548,10 @@ def main(args):
             shutil.rmtree(TEMP_DIR)
         logging.info(f"--- {APP_NAME} Finished ---")
 
+def run(full_run=False):
+    """Entry point for in-process invocation from the listener."""
+    main(argparse.Namespace(full_run=full_run))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generates preparation plans based on matched client data.")
     parser.add_argument("--full-run", action="store_true", help="Perform a full, clean run, regenerating all plans.")
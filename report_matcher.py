@@ -3,6 +3,7 @@
 import os
 import sys
 import json
+import bisect
 import logging
 import re
 import argparse
@@ -129,6 +130,22 @@ def download_file(session, file_id, destination_path):
         return True
     except Exception: return False
 
+def apply_scan_patch(session, scan_data, ntblm_folder_id):
+    """Applies the listener's append-only patch log on top of the snapshot, if one exists."""
+    patch_item = find_drive_item(session, "drive_scan_patch.jsonl", parent_id=ntblm_folder_id, drive_id=NTBLM_DRIVE_ID)
+    if not patch_item: return scan_data
+    local_patch_path = TEMP_DIR / "drive_scan_patch.jsonl"
+    if not download_file(session, patch_item['id'], local_patch_path): return scan_data
+    scan_by_id = {item['id']: item for item in scan_data}
+    with open(local_patch_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip(): continue
+            event = json.loads(line)
+            if event.get('op') == 'delete': scan_by_id.pop(event.get('id'), None)
+            elif event.get('op') == 'upsert' and event.get('item', {}).get('id'): scan_by_id[event['item']['id']] = event['item']
+    logging.info(f"Applied scan patch log on top of the snapshot ({len(scan_by_id)} items).")
+    return sorted(scan_by_id.values(), key=lambda item: item.get('path', ''))
+
 def cleanup_drive_outputs(session, ntblm_folder_id, drive_id):
     logging.warning("--- FULL RUN: Cleaning up previous outputs on Google Drive. ---")
     files_to_delete = ["matching_results.json", "matching_results_last_run.json"]
@@ -282,15 +299,30 @@ def generate_and_upload_client_trees(session, client_to_folders_map, scan_data,
         except Exception as e:
             logging.error(f"Failed to upload tree for '{master_name}': {e}")
 
+def build_path_index(scan_data):
+    """Path-sorted view of the scan so prefix scans become bisect range lookups."""
+    indexed = sorted(scan_data, key=lambda item: item.get('path', ''))
+    return [item.get('path', '') for item in indexed], indexed
+
+def items_under_path(paths, indexed, prefix):
+    results = []
+    for i in range(bisect.bisect_left(paths, prefix), len(paths)):
+        if not paths[i].startswith(prefix): break
+        results.append(indexed[i])
+    return results
+
 def get_client_file_signatures(scan_data, client_to_folders_map):
+    # One sorted index turns the per-client-folder O(N) startswith sweeps into
+    # O(log N + matches) range lookups.
+    paths, indexed = build_path_index(scan_data)
     client_signatures = {}
     for client_name, folder_info_list in client_to_folders_map.items():
         if not folder_info_list: continue
-        
+
         client_folder_paths = [f.get("path") for f in folder_info_list if f.get("path")]
         file_ids = set()
         for path in client_folder_paths:
-            file_ids.update({item['id'] for item in scan_data if item.get("path", "").startswith(path)})
+            file_ids.update(item['id'] for item in items_under_path(paths, indexed, path))
         client_signatures[client_name] = file_ids
     return client_signatures
 
@@ -348,6 +380,7 @@ def main(args):
             logging.info(f"Loaded {len(old_matches)} matches from the last run.")
 
         with open(local_current_scan_path, 'r', encoding='utf-8') as f: current_scan_data = [json.loads(line) for line in f if line.strip()]
+        current_scan_data = apply_scan_patch(session, current_scan_data, ntblm_folder_id)
         parsed_rows, raw_client_names = parse_report(local_report_path)
         
         new_clients_to_process = [name for name in raw_client_names if name not in old_consolidation]
@@ -436,6 +469,10 @@ def main(args):
             shutil.rmtree(TEMP_DIR)
         logging.info(f"{APP_NAME} finished.")
 
+def run(full_run=False):
+    """Entry point for in-process invocation from the listener."""
+    main(argparse.Namespace(full_run=full_run))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Matches client reports to Google Drive folders.")
     parser.add_argument("--full-run", action="store_true", help="Perform a full, clean run, ignoring previous matches.")